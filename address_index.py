@@ -0,0 +1,244 @@
+import heapq
+from array import array
+
+import numpy as np
+import pandas as pd
+import shapely
+
+import parcel_refs
+
+# In-memory search index over the `address` column, behind /api/search/address.
+# Addresses are normalized (lowercase, no accents or punctuation) and cut into
+# trigrams; each trigram maps to a sorted array of entry numbers, so a query is
+# a few array intersections instead of a scan of every parcel.
+# Word starts are indexed too (" ru", " r"), which is how 1-2 character queries
+# match: as word prefixes, where longer ones match anywhere like the old includes().
+#
+# Enrichments only ever add or replace a handful of addresses, so changes go to
+# small per-gram delta lists and a set of dead entries, folded into the arrays
+# every COMPACT_AFTER additions; nothing is rebuilt from scratch on a write.
+#
+# Each commune's entries and postings are also compiled into the parcel store
+# (compile_commune, see parcel_store.write_indexes), so communes whose parcels
+# aren't loaded are searchable by reading those instead of their geometries.
+COMPACT_AFTER = 2048
+SEARCH_LIMIT = 10
+# Candidates ranked per query: common words ("rue", "chemin") can hit a large
+# share of the index, and only the shortest addresses are worth ranking then
+VERIFY_LIMIT = 500
+BBOX_COLUMNS = ['minx', 'miny', 'maxx', 'maxy']
+
+
+def normalize(values):
+    """Search keys for a Series of strings: lowercase ASCII words separated by single spaces."""
+    return (values.astype(str).str.normalize('NFKD').str.encode('ascii', 'ignore').str.decode('ascii')
+            .str.lower().str.replace(r'[^a-z0-9]+', ' ', regex=True).str.strip())
+
+
+def index_grams(key):
+    padded = " " + key
+    grams = {padded[i:i + 3] for i in range(len(padded) - 2)}
+    grams.update(" " + w[0] for w in key.split())
+    return grams
+
+
+def query_grams(key):
+    if len(key) < 3:
+        return {" " + key}  # word prefix
+    return {key[i:i + 3] for i in range(len(key) - 2)}
+
+
+def _contains(sorted_values, items):
+    """Mask of items found in sorted_values: binary search per item, so cheap while items is the short side."""
+    pos = np.minimum(np.searchsorted(sorted_values, items), len(sorted_values) - 1)
+    return sorted_values[pos] == items
+
+
+def compile_commune(rows):
+    """
+    Index files of one commune's rows: a table of its parcels (id, address, key,
+    bbox), addressed ones first in entry order, and the postings of those entries
+    as {"grams", "offsets", "entries"} arrays. AddressIndex.load reads them back.
+    """
+    index = AddressIndex()
+    index._put(rows)
+    index._compact()
+    rest = rows[~rows['id'].isin(list(index.entry)).to_numpy()]
+    table = pd.DataFrame({
+        'id': index.ids + rest['id'].tolist(),
+        'address': index.labels + [None] * len(rest),
+        'key': index.keys + [""] * len(rest),
+    })
+    bounds = np.vstack([np.asarray(index.bboxes, dtype=float).reshape(-1, 4),
+                        np.round(shapely.bounds(rest.geometry.values), 7)])
+    table[BBOX_COLUMNS] = bounds
+    grams = sorted(index.postings)
+    lists = [index.postings[g] for g in grams]
+    return table, {
+        "grams": np.array(grams, dtype=str),
+        "offsets": np.cumsum([0] + [len(p) for p in lists]),
+        "entries": np.concatenate(lists).astype(np.int32) if lists else np.empty(0, dtype=np.int32),
+    }
+
+
+class AddressIndex:
+    """Searchable addresses by parcel id, with their bboxes. Caller serializes access."""
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.communes = set()  # communes whose addresses are indexed
+        self.ids, self.labels, self.keys, self.bboxes = [], [], [], []
+        self.lengths = array('H')
+        self.entry = {}  # parcel id -> its live entry number
+        self.dead = set()  # entries replaced since the last purge
+        self.postings = {}  # gram -> sorted int64 entry numbers
+        self.delta = {}  # gram -> entries added since the last compaction
+        self.pending = 0
+
+    def rebuild(self, gdf, codes):
+        """(Re)indexes the addresses of the given communes from the rows currently in gdf."""
+        if gdf is None:
+            return
+        rows = gdf[parcel_refs.commune_of(gdf['id']).isin(codes).to_numpy()]
+        self._put(rows)
+        self.communes.update(codes)
+
+    def load(self, code, table, postings, enrichments=None):
+        """
+        Indexes one commune from its compiled files (see compile_commune) without
+        its parcels, then replays the journal's address changes (id -> fields) on top.
+        """
+        self._compact()  # loaded entries are numbered after every existing one
+        ids = table['id'].tolist()
+        for pid in ids:
+            self._drop(pid)
+        keyed = int((table['key'] != "").sum())
+        n0 = len(self.ids)
+        self.ids += ids[:keyed]
+        self.labels += table['address'].iloc[:keyed].tolist()
+        self.keys += table['key'].iloc[:keyed].tolist()
+        self.bboxes += table[BBOX_COLUMNS].iloc[:keyed].to_numpy().tolist()
+        self.lengths.extend(min(len(k), 65535) for k in self.keys[n0:])
+        self.entry.update(zip(ids[:keyed], range(n0, n0 + keyed)))
+        offsets, entries = postings["offsets"], postings["entries"].astype(np.int64) + n0
+        for i, g in enumerate(postings["grams"].tolist()):
+            added = entries[offsets[i]:offsets[i + 1]]
+            self.postings[g] = np.concatenate([self.postings[g], added]) if g in self.postings else added
+        self.communes.add(code)
+
+        changed = {i: f['address'] for i, f in (enrichments or {}).items() if 'address' in f}
+        rows = table[table['id'].isin(list(changed)).to_numpy()]
+        self._replace(rows['id'].tolist(), pd.Series([changed[i] for i in rows['id']], dtype=object),
+                      rows[BBOX_COLUMNS].to_numpy())
+
+    def update(self, gdf, ids, positions=None):
+        """
+        Re-reads the addresses of the changed ids (at row `positions` of gdf when
+        the caller knows them). Communes that aren't in gdf are flagged as not
+        indexed and picked up again when they load.
+        """
+        if not ids:
+            return
+        if gdf is None:
+            self.communes -= {i[:5] for i in ids}
+            return
+        rows = gdf[gdf['id'].isin(ids)] if positions is None else gdf.iloc[positions]
+        self.communes -= {i[:5] for i in ids} - set(parcel_refs.commune_of(rows['id']))
+        self._put(rows)
+
+    def missing(self, codes):
+        return [c for c in codes if c not in self.communes]
+
+    def _put(self, rows):
+        rows = rows if 'address' in rows.columns else rows.assign(address=None)
+        self._replace(rows['id'].tolist(), rows['address'], np.round(shapely.bounds(rows.geometry.values), 7))
+
+    def _replace(self, ids, addresses, bounds):
+        # (Re)indexes ids with their addresses (a Series, null for none) and bbox rows
+        for pid in ids:
+            self._drop(pid)
+        has = addresses.notna().to_numpy()
+        ids = np.asarray(ids, dtype=object)[has]
+        keys = normalize(addresses[has])
+        for pid, label, key, bbox in zip(ids, addresses[has], keys, np.asarray(bounds)[has].tolist()):
+            if key:
+                self._add(pid, str(label), key, bbox)
+        if len(self.dead) > len(self.entry):
+            self._purge()
+        elif self.pending >= COMPACT_AFTER:
+            self._compact()
+
+    def _add(self, pid, label, key, bbox):
+        n = len(self.ids)
+        self.ids.append(pid)
+        self.labels.append(label)
+        self.keys.append(key)
+        self.bboxes.append(bbox)
+        self.lengths.append(min(len(key), 65535))
+        self.entry[pid] = n
+        for g in index_grams(key):
+            self.delta.setdefault(g, []).append(n)
+        self.pending += 1
+
+    def _drop(self, pid):
+        n = self.entry.pop(pid, None)
+        if n is not None:
+            self.dead.add(n)
+
+    def _compact(self):
+        # New entries are numbered after every existing one, so appending keeps arrays sorted
+        for g, added in self.delta.items():
+            added = np.asarray(added, dtype=np.int64)
+            self.postings[g] = np.concatenate([self.postings[g], added]) if g in self.postings else added
+        self.delta = {}
+        self.pending = 0
+
+    def _purge(self):
+        # Mostly replaced entries: renumber the live ones and index them again
+        live = sorted(self.entry.values())
+        old = (self.ids, self.labels, self.keys, self.bboxes)
+        communes = self.communes
+        self.clear()
+        self.communes = communes
+        for n in live:
+            self._add(old[0][n], old[1][n], old[2][n], old[3][n])
+        self._compact()
+
+    def _posting(self, gram):
+        p = self.postings.get(gram)
+        added = self.delta.get(gram)
+        if added:
+            added = np.asarray(added, dtype=np.int64)
+            return added if p is None else np.concatenate([p, added])
+        return p if p is not None else np.empty(0, dtype=np.int64)
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        """Best matches for query: [{"id", "address", "bbox"}], prefix matches first, then shorter addresses."""
+        key = normalize(pd.Series([query])).iloc[0]
+        if not key or not self.entry:
+            return []
+        postings = sorted((self._posting(g) for g in query_grams(key)), key=len)
+        cands = postings[0]
+        for p in postings[1:]:
+            if len(cands) == 0:
+                break
+            cands = cands[_contains(p, cands)]
+        if self.dead and len(cands):
+            dead = np.sort(np.fromiter(self.dead, dtype=np.int64, count=len(self.dead)))
+            cands = cands[~_contains(dead, cands)]
+        if len(cands) > VERIFY_LIMIT:
+            lengths = np.frombuffer(self.lengths, dtype=np.uint16)[cands]
+            cands = cands[np.argpartition(lengths, VERIFY_LIMIT)[:VERIFY_LIMIT]]
+
+        ranked = []
+        for n in cands.tolist():
+            k = self.keys[n]
+            # Trigrams can all be present without the query being (e.g. out of order)
+            if len(key) >= 3 and key not in k:
+                continue
+            rank = 0 if k.startswith(key) else 1 if (" " + key) in (" " + k) else 2
+            ranked.append((rank, len(k), k, n))
+        return [{"id": self.ids[n], "address": self.labels[n], "bbox": self.bboxes[n]}
+                for _, _, _, n in heapq.nsmallest(limit, ranked)]
@@ -2,11 +2,65 @@
 import requests
 import geopandas as gpd
 from shapely.geometry import Point, MultiPolygon, Polygon
-import math
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+import hubs
 
 # IGN Altimetry API (Free, no key required currently for low vol)
 IGN_ALTI_URL = "https://data.geopf.fr/altimetrie/1.0/calcul/alti/rest/elevation.json"
 
+# The provider lookups (IGN, BAN, DVF) don't depend on each other, so they run
+# side by side on a bounded pool under one overall deadline: a request costs the
+# slowest provider instead of the sum of all of them.
+PROVIDER_WORKERS = int(os.getenv("AGENT_PROVIDER_WORKERS", "8"))
+# Just over the slowest provider's own HTTP timeout (IGN, 10 s): slope decides
+# whether the fetch succeeds, so a deadline below it would turn slow but valid
+# IGN replies into failures. Lower it to trade those for a faster 502.
+PROVIDER_DEADLINE = float(os.getenv("AGENT_PROVIDER_DEADLINE", "11"))
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+def _pool():
+    # Created on first use, so it's never inherited across a gunicorn fork
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = ThreadPoolExecutor(max_workers=PROVIDER_WORKERS, thread_name_prefix="provider")
+        return _POOL
+
+def _timed(fn, args):
+    t0 = time.perf_counter()
+    try:
+        return fn(*args), round((time.perf_counter() - t0) * 1000)
+    except Exception as e:
+        print(f"Provider {fn.__name__} failed: {e}")
+        return None, round((time.perf_counter() - t0) * 1000)
+
+def run_providers(calls, deadline=PROVIDER_DEADLINE):
+    """
+    Runs {name: (fn, args, default)} concurrently and waits at most `deadline` seconds overall.
+    Returns ({name: result}, {name: ms}, [names that missed the deadline]).
+    A provider that fails or is late gives its default; a late one keeps running
+    in the background until its own HTTP timeout.
+    """
+    t0 = time.perf_counter()
+    futures = {name: _pool().submit(_timed, fn, args) for name, (fn, args, _) in calls.items()}
+    wait(list(futures.values()), timeout=deadline)
+    results, timings, late = {}, {}, []
+    for name, fut in futures.items():
+        default = calls[name][2]
+        if fut.done():
+            value, timings[name] = fut.result()
+            results[name] = default if value is None else value
+        else:
+            fut.cancel()
+            late.append(name)
+            results[name] = default
+            timings[name] = round((time.perf_counter() - t0) * 1000)
+    return results, timings, late
+
 def get_elevation_points(points):
     """
     Fetch elevations for a list of (lon, lat) tuples.
@@ -145,31 +199,15 @@ def get_address(lat, lon):
         print(f"Address API Error: {e}")
     return None
 
-def get_transport_info(lat, lon):
+def get_transport_info(lat, lon, commune=None):
     """
-    Calculates distance to Olympe Gondola.
-    Returns string description and distance in meters.
+    Calculates distance to the commune's transport hub (see hubs.HUBS).
+    Returns distance in meters and the hub name.
     """
-    # Olympe Gondola (Brides-les-Bains)
-    # Approx coords: 45.4526, 6.5658
-    hub_lat = 45.4526
-    hub_lon = 6.5658
-    
-    # Haversine
-    R = 6371000 # meters
-    phi1 = math.radians(lat)
-    phi2 = math.radians(hub_lat)
-    dphi = math.radians(hub_lat - lat)
-    dlambda = math.radians(hub_lon - lon)
-
-    a = math.sin(dphi/2)**2 + math.cos(phi1)*math.cos(phi2) * math.sin(dlambda/2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-    
-    dist = round(R * c)
-    
-    dist = round(R * c)
-    
-    return dist, "Olympe Gondola"
+    hub = hubs.get_hub(commune)
+    hub_lon, hub_lat = hub['coords']
+    dist = round(float(hubs.haversine(lon, lat, hub_lon, hub_lat)))
+    return dist, hub['name']
 
 def get_land_price_estimate(lat, lon):
     """
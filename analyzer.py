@@ -5,6 +5,8 @@ import pandas as pd
 from rasterstats import zonal_stats
 from shapely.geometry import shape
 import os
+import glob
+import parcel_store
 
 # France standard projection
 EPSG_LAMBERT_93 = 2154
@@ -153,7 +155,35 @@ def enrich_data(base_geojson_path, dem_path=None, plu_path=None, owners_path=Non
     print("Reprojecting to WGS84...")
     gdf = gdf.to_crs(epsg=4326)
     
-    # Save
-    gdf.to_file(base_geojson_path, driver='GeoJSON')
+    # Save (quantized, the to_crs round trip leaves 17-digit coordinates)
+    parcel_store.write_geojson(gdf, base_geojson_path)
+    # Cached server payloads were built from the old file
+    parcel_store.invalidate_snapshots(os.path.dirname(base_geojson_path))
     print("Enrichment complete.")
     return base_geojson_path
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Offline data preparation for the parcel server.")
+    parser.add_argument("command", choices=["build-store", "build-tiles", "compact"],
+                        help="build-store: compile cadastre_*.json / analysis_*.geojson into ./data/store; "
+                             "build-tiles: pre-render the parcel tile pyramid into ./data/store/parcels.mbtiles; "
+                             "compact: rewrite analysis_*.geojson with quantized coordinates")
+    parser.add_argument("--data-dir", default="./data")
+    parser.add_argument("--minzoom", type=int, default=10)
+    parser.add_argument("--maxzoom", type=int, default=18)
+    parser.add_argument("--force", action="store_true", help="build-tiles: re-tile every commune")
+    parser.add_argument("--precision", type=float, default=parcel_store.COORD_PRECISION,
+                        help="compact: coordinate grid in degrees")
+    args = parser.parse_args()
+
+    if args.command == "build-store":
+        parcel_store.build_store(args.data_dir)
+    elif args.command == "build-tiles":
+        import tile_archive
+        tile_archive.build_archive(args.data_dir, args.minzoom, args.maxzoom, force=args.force)
+    elif args.command == "compact":
+        for p in sorted(glob.glob(os.path.join(args.data_dir, "analysis_*.geojson"))):
+            parcel_store.write_geojson(gpd.read_file(p), p, args.precision)
+        parcel_store.invalidate_snapshots(args.data_dir)
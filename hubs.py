@@ -0,0 +1,37 @@
+import numpy as np
+
+# Transport hub per commune, (lon, lat). The one table for the server, the agent
+# and the map (served at /api/hubs).
+HUBS = {
+    '73057': {'name': 'Olympe Lift', 'coords': (6.566, 45.451)},      # Brides
+    '73284': {'name': 'Olympe Lift', 'coords': (6.566, 45.451)},      # Salins (Merged)
+    '73055': {'name': 'Bozel Center', 'coords': (6.6488, 45.4522)},   # Bozel
+    '73227': {'name': 'Le Praz Lift', 'coords': (6.628, 45.432)},     # Courchevel Le Praz
+}
+DEFAULT_HUB = '73057'
+
+EARTH_RADIUS_M = 6371000
+
+
+def get_hub(commune):
+    return HUBS.get(commune) or HUBS[DEFAULT_HUB]
+
+
+def haversine(lon, lat, lon2, lat2):
+    """Great-circle distance in metres; works on scalars and numpy arrays alike."""
+    phi1, phi2 = np.radians(lat), np.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = np.radians(np.asarray(lon2) - np.asarray(lon))
+    a = np.sin(dphi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def distances_to_hubs(communes, lon, lat):
+    """Distance (m) from each point to the hub of its commune, in one pass."""
+    communes = np.asarray(communes)
+    hub_lon = np.empty(len(communes))
+    hub_lat = np.empty(len(communes))
+    for code in np.unique(communes):
+        mask = communes == code
+        hub_lon[mask], hub_lat[mask] = get_hub(code)['coords']
+    return haversine(lon, lat, hub_lon, hub_lat)
@@ -0,0 +1,53 @@
+import contextlib
+import importlib
+import threading
+import time
+
+# Import timings in ms, in the order they happened (eager ones at startup,
+# deferred ones whenever a route first needs them)
+IMPORT_TIMES = {}
+
+_LOCK = threading.Lock()
+
+
+@contextlib.contextmanager
+def import_timer(label):
+    """Times the import statements inside the block under one label."""
+    t0 = time.perf_counter()
+    yield
+    IMPORT_TIMES[label] = (time.perf_counter() - t0) * 1000
+
+
+class LazyModule:
+    """
+    Stand-in for a module that is only imported on first attribute access,
+    e.g. `genai = lazy("google.generativeai")` then `genai.configure(...)`.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        with _LOCK:
+            if self._module is None:
+                with import_timer(self._name):
+                    module = importlib.import_module(self._name)
+                print(f"Deferred import {self._name}: {IMPORT_TIMES[self._name]:.0f} ms", flush=True)
+                self._module = module
+        return self._module
+
+    def __getattr__(self, attr):
+        module = self._module if self._module is not None else self._load()
+        return getattr(module, attr)
+
+
+def lazy(name):
+    return LazyModule(name)
+
+
+def report_import_times(title="Import time breakdown"):
+    total = sum(IMPORT_TIMES.values())
+    print(f"{title} ({total:.0f} ms total):", flush=True)
+    for label, ms in sorted(IMPORT_TIMES.items(), key=lambda kv: -kv[1]):
+        print(f"  {label:<24} {ms:8.0f} ms", flush=True)
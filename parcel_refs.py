@@ -0,0 +1,100 @@
+import re
+
+# Cadastral references -> parcels, behind /api/parcels/resolve.
+# A parcel id is commune (5) + prefixe (3) + section (2, zero padded) + numero (4),
+# e.g. 730570000C1228. Documents cite "section C, parcelle 1228" (or "C 1228",
+# "n°42"), so ids are parsed once per merged frame into a composite
+# (commune, section, numero) index, with numero alone for references that
+# come without a commune or a section.
+ID_LENGTH = 14
+# Near misses offered when a reference has no exact match
+FUZZY_LIMIT = 10
+
+NUMBER_RE = re.compile(r'\s*([A-Za-z]{1,2})?[\s-]*(?:n°)?\s*(\d{1,4})\s*', re.IGNORECASE)
+
+
+def commune_of(ids):
+    # Cadastral ids start with the INSEE commune code (e.g. 73057...)
+    return ids.astype(str).str[:5]
+
+
+def parse_id(parcel_id):
+    """(commune, prefixe, section, numero) of a parcel id, or None if it isn't a cadastral one."""
+    if len(parcel_id) != ID_LENGTH or not parcel_id[10:].isdigit():
+        return None
+    return parcel_id[:5], parcel_id[5:8], parcel_id[8:10].lstrip('0'), int(parcel_id[10:])
+
+
+def normalize_section(section):
+    section = str(section or "").strip().upper().lstrip('0')
+    return section or None
+
+
+def parse_reference(number, section=None):
+    """(section, numero) from a cited number like "1228", "0042", "C 1228"; numero is None if unreadable."""
+    m = NUMBER_RE.fullmatch(str(number))
+    if not m:
+        return normalize_section(section), None
+    return normalize_section(section or m.group(1)), int(m.group(2))
+
+
+def number_variants(numero):
+    """Numbers one OCR slip away: a digit changed, dropped, added, or two neighbours swapped."""
+    s = str(numero)
+    out = set()
+    for i in range(len(s) + 1):
+        for d in "0123456789":
+            out.add(s[:i] + d + s[i:])
+            if i < len(s):
+                out.add(s[:i] + d + s[i + 1:])
+        if i < len(s):
+            out.add(s[:i] + s[i + 1:])
+        if i < len(s) - 1:
+            out.add(s[:i] + s[i + 1] + s[i] + s[i + 2:])
+    # Closest numbers first: neighbouring parcels are numbered in sequence
+    return sorted({int(v) for v in out if v and len(v) <= 4} - {0, numero}, key=lambda v: (abs(v - numero), v))
+
+
+class RefIndex:
+    """(commune, section, numero) -> row positions of a frame's ids."""
+
+    def __init__(self, ids):
+        ids = list(ids)
+        self.communes = [None] * len(ids)
+        self.sections = [None] * len(ids)
+        self.exact = {}  # (commune, section, numero) -> positions
+        self.by_numero = {}  # numero -> positions
+        for pos, parcel_id in enumerate(ids):
+            parts = parse_id(str(parcel_id))
+            if parts is None:
+                continue
+            commune, _, section, numero = parts
+            self.communes[pos], self.sections[pos] = commune, section
+            self.exact.setdefault((commune, section, numero), []).append(pos)
+            self.by_numero.setdefault(numero, []).append(pos)
+
+    def find(self, numero, section=None, commune=None):
+        if commune and section:
+            return self.exact.get((commune, section, numero), [])
+        return [p for p in self.by_numero.get(numero, [])
+                if (commune is None or self.communes[p] == commune)
+                and (section is None or self.sections[p] == section)]
+
+    def resolve(self, number, section=None, commune=None, fuzzy_limit=FUZZY_LIMIT):
+        """
+        (exact, fuzzy) row positions for one cited number. Fuzzy is only filled
+        when nothing matches exactly: the same number in another section first
+        (misread section), then numbers one slip away in the section.
+        """
+        section, numero = parse_reference(number, section)
+        if numero is None:
+            return [], []
+        exact = self.find(numero, section, commune)
+        if exact:
+            return list(exact), []
+        fuzzy = list(self.find(numero, None, commune)) if section else []
+        for v in number_variants(numero):
+            if len(fuzzy) >= fuzzy_limit:
+                break
+            fuzzy += self.find(v, section, commune)
+        return [], list(dict.fromkeys(fuzzy))[:fuzzy_limit]
@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+
+import parcel_refs
+
+# Per-commune and per-section aggregates for the sidebar and analytics clients.
+# Computed when a commune loads and refreshed group by group when enrichments
+# land, so /api/stats never reduces over the whole frame on a request.
+# The store also keeps each commune's aggregates as compiled (commune_stats, see
+# parcel_store.write_indexes) for communes whose parcels aren't loaded.
+
+QUANTILES = [0.1, 0.25, 0.5, 0.75, 0.9]
+# Histogram edges; the last bin also counts everything above it
+HISTOGRAMS = {
+    'slope_mean': list(range(0, 95, 5)),
+    'est_price_m2': list(range(0, 1050, 50)),
+}
+# Everything the aggregates read, so they can be computed without the geometries
+COLUMNS = ['id', 'section', 'total_area_sqm', 'contenance'] + list(HISTOGRAMS)
+
+
+def parcel_area(gdf):
+    """The computed total_area_sqm where the analyzer filled it, otherwise the cadastral contenance."""
+    area = pd.to_numeric(gdf['total_area_sqm'], errors='coerce') if 'total_area_sqm' in gdf.columns else None
+    contenance = pd.to_numeric(gdf['contenance'], errors='coerce') if 'contenance' in gdf.columns else None
+    if area is None:
+        return contenance
+    return area.fillna(contenance) if contenance is not None else area
+
+
+def distribution(values, edges):
+    values = pd.to_numeric(values, errors='coerce').dropna().to_numpy(dtype=float)
+    out = {"count": int(len(values))}
+    if len(values) == 0:
+        return out
+    out["min"] = float(values.min())
+    out["max"] = float(values.max())
+    out["mean"] = round(float(values.mean()), 2)
+    out["quantiles"] = {str(q): round(float(v), 2) for q, v in zip(QUANTILES, np.quantile(values, QUANTILES))}
+    counts, _ = np.histogram(np.clip(values, edges[0], edges[-1]), bins=edges)
+    out["histogram"] = {"edges": edges, "counts": counts.tolist()}
+    return out
+
+
+def summarize(rows):
+    area = parcel_area(rows)
+    out = {
+        "parcels": int(len(rows)),
+        "area_known": int(area.notna().sum()),
+        "area_total_sqm": round(float(area.sum()), 1),
+        "area_mean_sqm": round(float(area.mean()), 1) if area.notna().any() else None,
+    }
+    for column, edges in HISTOGRAMS.items():
+        if column in rows.columns:
+            out[column] = distribution(rows[column], edges)
+    return out
+
+
+def commune_stats(rows):
+    """Aggregates of one commune's rows, with a breakdown by section."""
+    stats = summarize(rows)
+    stats["sections"] = {s: summarize(part) for s, part in rows.groupby(_sections(rows), sort=True)}
+    return stats
+
+
+def _sections(rows):
+    return rows['section'].fillna("").astype(str) if 'section' in rows.columns else pd.Series("", index=rows.index)
+
+
+class ParcelStats:
+    """Aggregates by commune code, each with its sections. Caller serializes access."""
+
+    def __init__(self):
+        self.communes = {}
+
+    def rebuild(self, gdf, codes):
+        """(Re)computes the given communes from the rows currently in gdf."""
+        if gdf is None:
+            return
+        keys = parcel_refs.commune_of(gdf['id'])
+        for code in codes:
+            rows = gdf[(keys == code).to_numpy()]
+            if len(rows) == 0:
+                continue
+            self.communes[code] = commune_stats(rows)
+
+    def load(self, code, stats):
+        """Takes a commune's compiled aggregates as they are (see commune_stats)."""
+        self.communes[code] = stats
+
+    def update(self, gdf, ids):
+        """
+        Refreshes only the sections (and their communes) holding the changed ids.
+        Communes that aren't in gdf are dropped and recomputed when they load again.
+        """
+        if not ids:
+            return
+        if gdf is None:
+            for code in {i[:5] for i in ids}:
+                self.communes.pop(code, None)
+            return
+        changed = gdf[gdf['id'].isin(ids)]
+        touched = {}
+        for code, section in zip(parcel_refs.commune_of(changed['id']), _sections(changed)):
+            touched.setdefault(code, set()).add(section)
+        for code in {i[:5] for i in ids} - set(touched):
+            self.communes.pop(code, None)
+
+        keys = parcel_refs.commune_of(gdf['id'])
+        for code, sections in touched.items():
+            if code not in self.communes:
+                continue  # never computed, done in full on request
+            rows = gdf[(keys == code).to_numpy()]
+            stats = summarize(rows)
+            stats["sections"] = self.communes[code]["sections"]
+            row_sections = _sections(rows)
+            for s in sections:
+                stats["sections"][s] = summarize(rows[(row_sections == s).to_numpy()])
+            self.communes[code] = stats
+
+    def clear(self):
+        self.communes = {}
+
+    def missing(self, codes):
+        return [c for c in codes if c not in self.communes]
+
+    def totals(self):
+        """Dataset-wide counts and areas (distributions are per commune)."""
+        known = sum(s["area_known"] for s in self.communes.values())
+        area = sum(s["area_total_sqm"] for s in self.communes.values())
+        return {
+            "parcels": sum(s["parcels"] for s in self.communes.values()),
+            "area_known": known,
+            "area_total_sqm": round(area, 1),
+            "area_mean_sqm": round(area / known, 1) if known else None,
+        }
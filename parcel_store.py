@@ -0,0 +1,842 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import shapely
+import json
+import math
+import glob
+import gzip
+import hashlib
+import os
+import time
+from contextlib import contextmanager
+
+import address_index
+import hubs
+import parcel_refs
+import parcel_stats
+import topology
+
+try:
+    import brotli  # optional, payloads are still gzipped without it
+except ImportError:
+    brotli = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows: builds aren't serialized across processes
+
+# Compiled parcel store: one GeoParquet file per commune + a manifest.
+# Parsing ~80 MB of GeoJSON on every boot is what makes workers slow to start,
+# so the text inputs are compiled once and the server only opens the binary files.
+STORE_DIRNAME = "store"
+MANIFEST_NAME = "manifest.json"
+STORE_FORMAT = 9
+ENRICHMENTS_NAME = "enrichments.jsonl"
+# Held while compiling, so workers booting on a cold store don't all compile it at once
+BUILD_LOCK_NAME = ".build.lock"
+# Whole dataset as FlatGeobuf (with its packed Hilbert R-tree), served as a static
+# file from /data/store/ so clients can range-read just the features in a bbox
+FLATGEOBUF_NAME = "parcels.fgb"
+
+LAMBERT_93 = 2154  # metric CRS for areas
+
+# Coordinates are quantized to this grid, in degrees (1e-7 ≈ 1 cm on the ground)
+COORD_PRECISION = float(os.getenv("COORD_PRECISION", "1e-7"))
+
+# Enrichment columns that must stay numeric (older analysis files hold slope_mean as text)
+NUMERIC_COLUMNS = ['slope_mean', 'dist_to_hub', 'est_price_m2', 'total_area_sqm', 'buildable_area_sqm']
+
+
+def store_dir(data_dir):
+    return os.path.join(data_dir, STORE_DIRNAME)
+
+
+def source_files(data_dir):
+    """
+    Input files in load priority order.
+    Analysis outputs come first so their enriched rows win the dedupe on 'id'.
+    """
+    analysis = sorted(glob.glob(os.path.join(data_dir, "analysis_*.geojson")))
+    cadastre = sorted(glob.glob(os.path.join(data_dir, "cadastre_*.json")))
+    return analysis + cadastre
+
+
+def file_hash(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_fingerprint(path, with_hash=False):
+    st = os.stat(path)
+    fp = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    if with_hash:
+        fp["hash"] = file_hash(path)
+    return fp
+
+
+def source_fingerprints(data_dir, with_hash=True):
+    return {os.path.basename(p): file_fingerprint(p, with_hash) for p in source_files(data_dir)}
+
+
+commune_of = parcel_refs.commune_of
+
+
+def read_sources(data_dir):
+    """
+    Parses every input file and returns the merged, deduplicated GeoDataFrame.
+    This is the slow path the store exists to avoid.
+    """
+    gdfs = []
+    for p in source_files(data_dir):
+        try:
+            print(f"Loading {os.path.basename(p)}...", flush=True)
+            gdfs.append(gpd.read_file(p))
+        except Exception as e:
+            print(f"Error loading {os.path.basename(p)}: {e}", flush=True)
+
+    if not gdfs:
+        return None
+
+    gdf = pd.concat(gdfs, ignore_index=True)
+    gdf = gdf.drop_duplicates(subset=['id'])
+
+    # FIX: Timestamp serialization error
+    # Convert all datetime objects to string once, at compile time
+    for col in gdf.columns:
+        if pd.api.types.is_datetime64_any_dtype(gdf[col]):
+            gdf[col] = gdf[col].astype(str)
+    for col in NUMERIC_COLUMNS:
+        if col in gdf.columns:
+            gdf[col] = pd.to_numeric(gdf[col], errors='coerce')
+
+    return derive_columns(compact_geometries(gdf))
+
+
+def derive_columns(gdf):
+    """
+    What the map used to work out per feature in the browser, for every parcel
+    in one vectorized pass: Lambert-93 areas where the analyzer hasn't set
+    total_area_sqm, a representative point (center_lon/center_lat, always inside
+    the parcel) and the distance from it to the commune's hub.
+    """
+    area = gdf.geometry.to_crs(epsg=LAMBERT_93).area.round(1)
+    gdf['total_area_sqm'] = gdf['total_area_sqm'].fillna(area) if 'total_area_sqm' in gdf.columns else area
+    points = shapely.point_on_surface(gdf.geometry.values)
+    gdf['center_lon'] = np.round(shapely.get_x(points), 7)
+    gdf['center_lat'] = np.round(shapely.get_y(points), 7)
+    gdf['dist_to_hub'] = np.round(hubs.distances_to_hubs(commune_of(gdf['id']), gdf['center_lon'], gdf['center_lat']))
+    return gdf
+
+
+def write_store(gdf, data_dir):
+    """
+    Writes one GeoParquet file per commune and a manifest recording which
+    source files (size + mtime) the store was compiled from.
+    """
+    out_dir = store_dir(data_dir)
+    os.makedirs(out_dir, exist_ok=True)
+
+    communes = {}
+    keys = commune_of(gdf['id'])
+    for code, part in gdf.groupby(keys, sort=True):
+        fname = f"parcels_{code}.parquet"
+        tmp = os.path.join(out_dir, f"{fname}.{os.getpid()}.tmp")
+        # Uncompressed so the loader can memory-map the column buffers
+        part.reset_index(drop=True).to_parquet(tmp, compression=None)
+        os.replace(tmp, os.path.join(out_dir, fname))
+        communes[code] = {
+            "file": fname,
+            "rows": int(len(part)),
+            "bounds": [round(float(v), 7) for v in part.total_bounds],
+            "lods": write_lods(part, out_dir, code),
+            **write_indexes(part, out_dir, code),
+        }
+
+    write_flatgeobuf(gdf, out_dir)
+
+    # Dataset versions carry on from the previous build and move one past it, so
+    # clients holding a version from before this rebuild can tell (see CommuneRegistry)
+    previous = read_manifest(data_dir) or {}
+    records = len(read_journal_since(data_dir, 0)[0])
+    rebuilt_at = previous.get("version_base", 0) + records + 1
+
+    manifest = {
+        "format": STORE_FORMAT,
+        "built_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "version_base": rebuilt_at - records,
+        "rebuilt_at": rebuilt_at,
+        "crs": gdf.crs.to_string() if gdf.crs else None,
+        "sources": source_fingerprints(data_dir),
+        "communes": communes,
+    }
+    _write_json(os.path.join(out_dir, MANIFEST_NAME), manifest)
+    # Payloads serialized from the previous store must not be served again
+    invalidate_snapshots(data_dir)
+    return manifest
+
+
+def write_flatgeobuf(gdf, out_dir):
+    path = os.path.join(out_dir, FLATGEOBUF_NAME)
+    tmp = os.path.join(out_dir, f"tmp_{os.getpid()}_{FLATGEOBUF_NAME}")
+    try:
+        gdf.to_file(tmp, driver="FlatGeobuf", SPATIAL_INDEX="YES")
+        os.replace(tmp, path)
+    except Exception as e:
+        # Optional export: the store itself is still usable without it
+        print(f"Could not write {FLATGEOBUF_NAME}: {e}", flush=True)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return None
+    print(f"Wrote {FLATGEOBUF_NAME}: {os.path.getsize(path) / 1e6:.1f} MB", flush=True)
+    return path
+
+
+def _write_json(path, data):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp, path)
+
+
+@contextmanager
+def _build_lock(data_dir):
+    lock = None
+    if fcntl is not None:
+        try:
+            os.makedirs(store_dir(data_dir), exist_ok=True)
+            lock = open(os.path.join(store_dir(data_dir), BUILD_LOCK_NAME), 'w')
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        except OSError:
+            lock = None  # read-only FS: nothing will be written anyway
+    try:
+        yield
+    finally:
+        if lock is not None:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+
+def build_store(data_dir, if_stale=False):
+    """
+    Compiles the GeoJSON inputs into the store. Returns the merged GeoDataFrame
+    so callers that just built the store don't have to read it back.
+    One process compiles at a time; with if_stale, a process that waited for
+    another one's build finds the store fresh and returns None without compiling.
+    """
+    with _build_lock(data_dir):
+        if if_stale and is_fresh(read_manifest(data_dir), data_dir):
+            print("Parcel store was compiled by another process meanwhile.", flush=True)
+            return None
+
+        t0 = time.time()
+        gdf = read_sources(data_dir)
+        if gdf is None:
+            print("CRITICAL: No source files to compile!", flush=True)
+            return None
+
+        try:
+            manifest = write_store(gdf, data_dir)
+            print(f"Parcel store built: {len(gdf)} parcels in {len(manifest['communes'])} communes "
+                  f"({time.time() - t0:.1f}s)", flush=True)
+        except Exception as e:
+            # Read-only FS: keep serving from the parsed frame
+            print(f"Could not write parcel store: {e}", flush=True)
+        return gdf
+
+
+def read_manifest(data_dir):
+    p = os.path.join(store_dir(data_dir), MANIFEST_NAME)
+    if not os.path.exists(p):
+        return None
+    try:
+        with open(p, 'r') as f:
+            return json.load(f)
+    except:
+        return None
+
+
+def is_fresh(manifest, data_dir):
+    """
+    The store is usable if it was compiled from exactly the current inputs.
+    Size + mtime is the fast path; a file whose mtime moved (checkout, copy, touch)
+    is only hashed, and still counts as unchanged if the content hash matches.
+    """
+    if not manifest or manifest.get("format") != STORE_FORMAT:
+        return False
+    recorded = manifest.get("sources", {})
+    current = source_files(data_dir)
+    if sorted(recorded) != sorted(os.path.basename(p) for p in current):
+        return False
+
+    touched = False
+    for p in current:
+        fp = recorded[os.path.basename(p)]
+        st = os.stat(p)
+        if st.st_size != fp["size"]:
+            return False
+        if st.st_mtime_ns != fp["mtime_ns"]:
+            if file_hash(p) != fp.get("hash"):
+                return False
+            fp["mtime_ns"] = st.st_mtime_ns
+            touched = True
+
+    if touched:
+        # Remember the new mtimes so the next check takes the fast path again
+        try:
+            _write_json(os.path.join(store_dir(data_dir), MANIFEST_NAME), manifest)
+        except Exception:
+            pass
+    return True
+
+
+def read_commune(data_dir, manifest, code):
+    p = os.path.join(store_dir(data_dir), manifest["communes"][code]["file"])
+    return gpd.read_parquet(p, memory_map=True)
+
+
+def commune_fingerprint(data_dir, manifest, code):
+    """Content hash of one commune: its compiled parcels plus its journal entries."""
+    info = manifest["communes"][code]
+    h = hashlib.blake2b(digest_size=8)
+    for fname in [info["file"]] + sorted(info.get("lods", {}).values()):
+        h.update(file_hash(os.path.join(store_dir(data_dir), fname)).encode())
+    h.update(json.dumps(read_enrichments(data_dir, code), sort_keys=True).encode())
+    return h.hexdigest()
+
+
+# --- Levels of detail ---
+# Simplified copies of each commune's geometries for low zooms, written next to
+# the commune file at compile time. coverage_simplify simplifies the shared edges
+# once for both neighbours, so adjacent parcels don't open gaps or overlap.
+LOD_ZOOMS = [12, 14, 16]  # above the last one the full geometry is served
+
+
+def lod_tolerance(zoom):
+    # Half a 256px screen pixel at that zoom, in degrees
+    return 360.0 / (256 * 2 ** zoom) / 2
+
+
+def lod_level(zoom=None, tolerance=None):
+    """
+    LOD zoom to serve for a requested map zoom or simplification tolerance (degrees).
+    None means full detail.
+    """
+    if tolerance is not None:
+        # coarsest level that is still at least as precise as asked
+        levels = [z for z in LOD_ZOOMS if lod_tolerance(z) <= tolerance]
+    elif zoom is not None:
+        levels = [z for z in LOD_ZOOMS if z >= zoom]
+    else:
+        return None
+    return min(levels) if levels else None
+
+
+# What the map styles and filters read; popups and the sidebar get the rest of a
+# parcel from /api/parcels/attributes or /api/parcels/batch when it is opened
+LOD_PROPERTIES = ['id', 'total_area_sqm']
+
+
+def lod_visible(geoms, zoom):
+    """Mask of the LOD geometries that cover at least one screen pixel at that zoom (like tiles.MIN_FEATURE_AREA)."""
+    px = 360.0 / (256 * 2 ** zoom)
+    bounds = shapely.bounds(geoms)
+    # A pixel spans fewer degrees of latitude than of longitude away from the equator
+    lat = np.radians((bounds[:, 1] + bounds[:, 3]) / 2)
+    return shapely.area(geoms) >= px * px * np.cos(lat)
+
+
+def lod_frame(gdf, lod, rows):
+    """gdf rows at `rows` with their LOD geometries and LOD_PROPERTIES only."""
+    cols = [c for c in LOD_PROPERTIES if c in gdf.columns]
+    return gpd.GeoDataFrame(gdf[cols].iloc[rows].reset_index(drop=True), geometry=lod[rows], crs=gdf.crs)
+
+
+def simplify_lod(geoms, zoom):
+    tol = lod_tolerance(zoom)
+    out = shapely.coverage_simplify(geoms, tol)
+    # Coordinates don't need more digits than the level shows either
+    return shapely.set_precision(out, 10 ** math.floor(math.log10(tol / 4)))
+
+
+def write_lods(part, out_dir, code):
+    lods = {}
+    for zoom in LOD_ZOOMS:
+        fname = f"parcels_{code}_z{zoom}.parquet"
+        tmp = os.path.join(out_dir, f"{fname}.{os.getpid()}.tmp")
+        lod = gpd.GeoDataFrame({'id': part['id'].to_numpy()},
+                               geometry=simplify_lod(part.geometry.values, zoom), crs=part.crs)
+        lod.to_parquet(tmp, compression=None)
+        os.replace(tmp, os.path.join(out_dir, fname))
+        lods[str(zoom)] = fname
+    return lods
+
+
+def read_lod(data_dir, manifest, code, zoom):
+    """GeoSeries of the commune's geometries at that level, indexed by parcel id."""
+    p = os.path.join(store_dir(data_dir), manifest["communes"][code]["lods"][str(zoom)])
+    lod = gpd.read_parquet(p, memory_map=True)
+    return lod.set_index('id').geometry
+
+
+def lod_geometries(data_dir, manifest, gdf, zoom):
+    """Array of LOD geometries aligned row for row with gdf (None where unknown)."""
+    keys = commune_of(gdf['id'])
+    if manifest is None:
+        # No store on disk: simplify in memory
+        out = np.empty(len(gdf), dtype=object)
+        for code in keys.unique():
+            mask = (keys == code).to_numpy()
+            out[mask] = simplify_lod(gdf.geometry.values[mask], zoom)
+        return out
+    parts = [read_lod(data_dir, manifest, c, zoom) for c in sorted(keys.unique()) if c in manifest["communes"]]
+    if not parts:
+        return np.full(len(gdf), None, dtype=object)
+    return pd.concat(parts).reindex(gdf['id']).to_numpy()
+
+
+# --- Search and stats indexes ---
+# Each commune's address index and aggregates are compiled with it, so
+# /api/search/address and /api/stats can cover communes whose parcels were
+# never loaded (or were evicted) without reading their geometries.
+
+def write_indexes(part, out_dir, code):
+    names = {"addresses": f"addresses_{code}.parquet", "postings": f"postings_{code}.npz",
+             "stats": f"stats_{code}.json"}
+    table, postings = address_index.compile_commune(part)
+    tmp = os.path.join(out_dir, f"{names['addresses']}.{os.getpid()}.tmp")
+    table.to_parquet(tmp, index=False)
+    os.replace(tmp, os.path.join(out_dir, names["addresses"]))
+    tmp = os.path.join(out_dir, f"{names['postings']}.{os.getpid()}.tmp")
+    with open(tmp, 'wb') as f:
+        np.savez(f, **postings)
+    os.replace(tmp, os.path.join(out_dir, names["postings"]))
+    _write_json(os.path.join(out_dir, names["stats"]), parcel_stats.commune_stats(part))
+    return names
+
+
+def read_address_index(data_dir, manifest, code):
+    """(table, postings) of one commune, for address_index.AddressIndex.load."""
+    info = manifest["communes"][code]
+    table = pd.read_parquet(os.path.join(store_dir(data_dir), info["addresses"]))
+    with np.load(os.path.join(store_dir(data_dir), info["postings"])) as z:
+        postings = {k: z[k] for k in z.files}
+    return table, postings
+
+
+def read_stats(data_dir, manifest, code):
+    with open(os.path.join(store_dir(data_dir), manifest["communes"][code]["stats"]), 'r') as f:
+        return json.load(f)
+
+
+def read_attributes(data_dir, manifest, code, columns):
+    """The commune's rows with just the given attribute columns (those it has), no geometries."""
+    p = os.path.join(store_dir(data_dir), manifest["communes"][code]["file"])
+    names = pq.read_schema(p).names
+    return pd.read_parquet(p, columns=[c for c in columns if c in names])
+
+
+# --- Compaction ---
+# The to_crs round trip in the analyzer leaves 15-17 significant digits per
+# coordinate. Snapping to COORD_PRECISION shrinks the files without any visible change.
+# Parcels are snapped one by one but onto the same grid, so neighbours keep
+# identical shared edges; no per-polygon simplify here, it would drop different
+# vertices from each side of an edge (LODs use coverage_simplify for that).
+
+def compact_geometries(gdf, precision=COORD_PRECISION):
+    """Returns gdf with coordinates snapped to the precision grid (and the repeated points that leaves removed)."""
+    if gdf is None or len(gdf) == 0 or not precision:
+        return gdf
+    geoms = gdf.geometry.values
+    before = int(shapely.get_num_coordinates(geoms).sum())
+    geoms = shapely.set_precision(geoms, precision)
+    gdf = gdf.copy()
+    gdf[gdf.geometry.name] = geoms
+    after = int(shapely.get_num_coordinates(geoms).sum())
+    print(f"Compacted geometries: {before} -> {after} vertices", flush=True)
+    return gdf
+
+
+def write_geojson(gdf, path, precision=COORD_PRECISION):
+    """
+    Writes gdf as compact GeoJSON (quantized coordinates, no whitespace) through a
+    temp file, and reports the size against the file it replaces.
+    """
+    before = os.path.getsize(path) if os.path.exists(path) else None
+    gdf = compact_geometries(gdf, precision)
+    for col in gdf.columns:
+        if pd.api.types.is_datetime64_any_dtype(gdf[col]):
+            # Same text as the store (e.g. '2003-10-02'), missing dates stay null
+            gdf[col] = gdf[col].astype(str).where(gdf[col].notna(), None)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        f.write(gdf.to_json(drop_id=True, separators=(',', ':'), default=str))
+    os.replace(tmp, path)
+    after = os.path.getsize(path)
+    was = f"{before / 1e6:.1f} MB -> " if before is not None else ""
+    print(f"Wrote {os.path.basename(path)}: {was}{after / 1e6:.1f} MB", flush=True)
+    return path
+
+
+def write_topojson(gdf, path, precision=COORD_PRECISION):
+    """Same as write_geojson, as TopoJSON with shared arcs (see topology.py)."""
+    gdf = compact_geometries(gdf, precision)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        f.write(topology.to_topojson(gdf, precision))
+    os.replace(tmp, path)
+    print(f"Wrote {os.path.basename(path)}: {os.path.getsize(path) / 1e6:.1f} MB", flush=True)
+    return path
+
+
+# --- Payload snapshots ---
+# Serialized GeoJSON payloads are kept in the store under a snapshot id derived
+# from the source content hashes and the enrichment journal. A file for the
+# current id can be served as-is on the next boot; any change to the inputs
+# yields a new id, so stale payloads are simply never looked up again.
+
+def snapshot_id(data_dir, manifest=None):
+    sources = manifest["sources"] if manifest else source_fingerprints(data_dir)
+    journal = os.path.join(data_dir, ENRICHMENTS_NAME)
+    fp = {
+        "sources": {name: f.get("hash") for name, f in sorted(sources.items())},
+        "journal": file_fingerprint(journal) if os.path.exists(journal) else None,
+        # Same inputs compiled by different code or settings give different payloads
+        "format": STORE_FORMAT,
+        "precision": COORD_PRECISION,
+        "built_at": manifest.get("built_at") if manifest else None,
+    }
+    return hashlib.blake2b(json.dumps(fp, sort_keys=True).encode(), digest_size=8).hexdigest()
+
+
+# Precompressed siblings of each payload, by Content-Encoding, in order of preference
+PAYLOAD_ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+
+
+# Payload formats: file extension -> writer
+PAYLOAD_FORMATS = ["geojson", "topojson"]
+
+
+def payload_path(data_dir, key, snapshot, fmt="geojson"):
+    return os.path.join(store_dir(data_dir), f"payload_{key}.{snapshot}.{fmt}")
+
+
+def compress_payload(path):
+    """Writes path.gz (and path.br when brotli is installed) next to the payload."""
+    with open(path, 'rb') as f:
+        raw = f.read()
+    encoders = {"gzip": lambda b: gzip.compress(b, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        encoders["br"] = lambda b: brotli.compress(b, quality=9)
+    for encoding, suffix in PAYLOAD_ENCODINGS:
+        if encoding in encoders:
+            tmp = f"{path}{suffix}.{os.getpid()}.tmp"
+            with open(tmp, 'wb') as f:
+                f.write(encoders[encoding](raw))
+            os.replace(tmp, path + suffix)
+
+
+def write_payload(gdf, data_dir, key, snapshot, fmt="geojson"):
+    """Serializes gdf as the payload for key and drops older snapshots of it."""
+    path = payload_path(data_dir, key, snapshot, fmt)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Written aside and swapped so concurrent readers never see a half-written file
+    if fmt == "topojson":
+        write_topojson(gdf, path)
+    else:
+        write_geojson(gdf, path)
+    compress_payload(path)
+    for old in glob.glob(payload_path(data_dir, key, "*", fmt) + "*"):
+        if old.endswith(".tmp"):
+            continue  # another worker writing its snapshot right now
+        if not old.startswith(path):
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+    return path
+
+
+def invalidate_snapshots(data_dir):
+    """Drops every cached payload (called when the analysis inputs are rewritten)."""
+    for old in glob.glob(payload_path(data_dir, "*", "*", "*") + "*"):
+        if old.endswith(".tmp"):
+            continue  # being written right now
+        try:
+            os.remove(old)
+        except OSError:
+            pass
+
+
+# --- Enrichment journal ---
+# Agent enrichments are appended to ENRICHMENTS_NAME instead of rewriting the
+# whole analysis file, and replayed on top of the store whenever a commune is loaded.
+# It is also how a write made by one gunicorn worker reaches the others: every
+# process tails the journal from its last offset (CommuneRegistry.sync_journal).
+
+
+def append_enrichment(data_dir, parcel_id, fields):
+    rec = {"id": parcel_id, "at": time.strftime("%Y-%m-%dT%H:%M:%S"), "fields": fields}
+    with open(os.path.join(data_dir, ENRICHMENTS_NAME), 'a') as f:
+        f.write(json.dumps(rec) + "\n")
+
+
+def read_enrichments(data_dir, commune=None):
+    """Returns {parcel_id: fields}, later entries overriding earlier ones."""
+    p = os.path.join(data_dir, ENRICHMENTS_NAME)
+    out = {}
+    if not os.path.exists(p):
+        return out
+    with open(p, 'r') as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue  # partial line from an interrupted write
+            if commune and not rec["id"].startswith(commune):
+                continue
+            out.setdefault(rec["id"], {}).update(rec["fields"])
+    return out
+
+
+def read_journal_since(data_dir, offset):
+    """
+    Returns ([records], new_offset) for the complete lines written after offset.
+    Each record is one row change; its position in the file is its version.
+    """
+    p = os.path.join(data_dir, ENRICHMENTS_NAME)
+    out = []
+    if not os.path.exists(p) or os.path.getsize(p) <= offset:
+        return out, offset
+    with open(p, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break  # still being written, pick it up next time
+            offset += len(line)
+            try:
+                out.append(json.loads(line))
+            except ValueError:
+                continue
+    return out, offset
+
+
+def apply_enrichments(gdf, enrichments, rows=None):
+    """
+    Writes journal fields onto gdf in place. rows (id -> row position, see
+    CommuneRegistry.rows) spares the scan of the id column.
+    """
+    if not enrichments:
+        return gdf
+    if rows is None:
+        hits = gdf.index[gdf['id'].isin(list(enrichments))]
+    else:
+        hits = gdf.index[[rows[i] for i in enrichments if i in rows]]
+    for idx in hits:
+        for col, val in enrichments[gdf.at[idx, 'id']].items():
+            gdf.at[idx, col] = val
+    return gdf
+
+
+# --- Lazy commune registry ---
+
+def estimate_bytes(gdf):
+    """Rough resident size: attribute columns plus ~16 bytes per vertex and per-object overhead."""
+    attrs = gdf.drop(columns=gdf.geometry.name).memory_usage(deep=True).sum()
+    coords = shapely.get_num_coordinates(gdf.geometry.values).sum()
+    return int(attrs + coords * 16 + len(gdf) * 100)
+
+
+class CommuneRegistry:
+    """
+    Loads communes from the store the first time they are requested and keeps
+    the merged frame of whatever is currently active in self.gdf.
+    When budget_mb is set, least recently used communes are dropped once the
+    estimated footprint goes over it (communes being requested are never evicted).
+    """
+
+    def __init__(self, data_dir, budget_mb=0):
+        self.data_dir = data_dir
+        self.budget_bytes = int(float(budget_mb) * 1024 * 1024)
+        self.manifest = None
+        self.gdf = None
+        self.sizes = {}      # commune -> estimated bytes while loaded
+        self.last_used = {}  # commune -> time.monotonic() of last request
+        self.journal_offset = 0
+        self.version = 0     # store version base + journal records seen, the same in every worker
+        self.rebuilt_at = 0  # version the current store was built at; older ones predate its rows
+        self.changes = {}    # parcel id -> version of its last change
+        self._lods = {}      # zoom -> LOD geometries aligned with self.gdf
+        self._lods_for = None
+        self._rows = {}      # parcel id -> row position in self.gdf
+        self._rows_for = None
+        self._refs = None    # parcel_refs.RefIndex over self.gdf
+        self._refs_for = None
+
+    def open(self, rebuild=False):
+        """Reads the manifest, compiling the store first if it is missing or stale."""
+        manifest = read_manifest(self.data_dir)
+        gdf = None
+        if rebuild or not is_fresh(manifest, self.data_dir):
+            print("Parcel store missing or stale, compiling from GeoJSON...", flush=True)
+            gdf = build_store(self.data_dir, if_stale=True)
+            manifest = read_manifest(self.data_dir)
+            if not is_fresh(manifest, self.data_dir):
+                manifest = None
+
+        # Communes replay the whole journal when they load; only follow what comes after,
+        # but number every record so far for the change log
+        records, self.journal_offset = read_journal_since(self.data_dir, 0)
+        self.version = manifest.get("version_base", 0) if manifest else 0
+        self.rebuilt_at = manifest.get("rebuilt_at", 0) if manifest else 0
+        self.changes = {}
+        self._log(records)
+        if manifest is None:
+            # Store could not be written: everything stays resident, nothing to page in
+            self.manifest = None
+            self.gdf = apply_enrichments(gdf, read_enrichments(self.data_dir)) if gdf is not None else None
+            self.sizes = {c: 0 for c in self.known()}
+            return
+        self.manifest = manifest
+
+    def reload(self):
+        """Recompiles the store (inputs changed on disk) and reloads the active communes."""
+        active = self.loaded()
+        self.manifest = None
+        self.gdf = None
+        self.sizes = {}
+        self.open(rebuild=True)
+        if self.manifest is not None:
+            self.activate(active)
+
+    def sync_journal(self):
+        """
+        Applies enrichments appended since the last call (by this or any other process).
+        Returns the ids that were updated.
+        """
+        records, self.journal_offset = read_journal_since(self.data_dir, self.journal_offset)
+        self._log(records)
+        enrichments = {}
+        for rec in records:
+            enrichments.setdefault(rec["id"], {}).update(rec["fields"])
+        if enrichments and self.gdf is not None:
+            apply_enrichments(self.gdf, enrichments, self.rows())
+        return list(enrichments)
+
+    def _log(self, records):
+        # Dataset version = store base + number of journal records; changes = id -> version of its last change
+        for rec in records:
+            self.version += 1
+            self.changes[rec["id"]] = self.version
+
+    def changed_since(self, version):
+        """Ids changed after `version`, oldest change first."""
+        return [i for v, i in sorted((v, i) for i, v in self.changes.items() if v > version)]
+
+    def is_stale(self):
+        """True when the inputs changed on disk since the store was opened (e.g. analyzer run)."""
+        return self.manifest is not None and not is_fresh(self.manifest, self.data_dir)
+
+    def snapshot(self):
+        return snapshot_id(self.data_dir, self.manifest)
+
+    def known(self):
+        if self.manifest is not None:
+            return sorted(self.manifest["communes"])
+        if self.gdf is not None:
+            return sorted(commune_of(self.gdf['id']).unique())
+        return []
+
+    def loaded(self):
+        return sorted(self.sizes)
+
+    def intersecting(self, bbox):
+        """Communes whose extent overlaps bbox (west, south, east, north)."""
+        if self.manifest is None:
+            return self.known()
+        w, s, e, n = bbox
+        out = []
+        for code, info in self.manifest["communes"].items():
+            cw, cs, ce, cn = info["bounds"]
+            if cw <= e and ce >= w and cs <= n and cn >= s:
+                out.append(code)
+        return sorted(out)
+
+    def activate(self, codes):
+        """
+        Makes sure the given communes are part of self.gdf.
+        Returns (loaded, evicted) lists of commune codes.
+        """
+        now = time.monotonic()
+        codes = [c for c in codes if c in self.known()]
+        for c in codes:
+            self.last_used[c] = now
+        missing = [c for c in codes if c not in self.sizes]
+        if not missing or self.manifest is None:
+            return [], []
+
+        parts = [] if self.gdf is None else [self.gdf]
+        for c in missing:
+            t0 = time.time()
+            part = read_commune(self.data_dir, self.manifest, c)
+            part = apply_enrichments(part, read_enrichments(self.data_dir, c))
+            self.sizes[c] = estimate_bytes(part)
+            parts.append(part)
+            print(f"Commune {c} loaded: {len(part)} parcels, "
+                  f"~{self.sizes[c] / 1024 / 1024:.0f} MB ({(time.time() - t0) * 1000:.0f} ms)", flush=True)
+        self.gdf = pd.concat(parts, ignore_index=True)
+
+        return missing, self._evict(keep=set(codes))
+
+    def _evict(self, keep):
+        if not self.budget_bytes:
+            return []
+        victims = []
+        total = sum(self.sizes.values())
+        for c in sorted(self.sizes, key=lambda c: self.last_used.get(c, 0)):
+            if total <= self.budget_bytes:
+                break
+            if c in keep:
+                continue
+            victims.append(c)
+            total -= self.sizes.pop(c)
+        if victims:
+            self.gdf = self.gdf[~commune_of(self.gdf['id']).isin(victims)].reset_index(drop=True)
+            print(f"Evicted communes {victims} (budget {self.budget_bytes / 1024 / 1024:.0f} MB)", flush=True)
+        return victims
+
+    def lod(self, zoom):
+        """Geometries at LOD `zoom` aligned row for row with self.gdf, cached until it changes."""
+        if self._lods_for is not self.gdf:
+            self._lods, self._lods_for = {}, self.gdf
+        if zoom not in self._lods and self.gdf is not None:
+            self._lods[zoom] = lod_geometries(self.data_dir, self.manifest, self.gdf, zoom)
+        return self._lods.get(zoom)
+
+    def rows(self):
+        """Parcel id -> row position in self.gdf, rebuilt (once) whenever self.gdf is replaced."""
+        if self._rows_for is not self.gdf:
+            ids = [] if self.gdf is None else self.gdf['id'].tolist()
+            self._rows, self._rows_for = dict(zip(ids, range(len(ids)))), self.gdf
+        return self._rows
+
+    def row(self, parcel_id):
+        """Row position of parcel_id in self.gdf, or None if it isn't loaded."""
+        return self.rows().get(parcel_id)
+
+    def refs(self):
+        """Cadastral reference index (commune, section, numero) over self.gdf, rebuilt whenever it is replaced."""
+        if self._refs_for is not self.gdf or self._refs is None:
+            self._refs = parcel_refs.RefIndex([] if self.gdf is None else self.gdf['id'])
+            self._refs_for = self.gdf
+        return self._refs
+
+    def positions(self, ids):
+        """Row positions of the loaded ids among `ids`, in the order given."""
+        rows = self.rows()
+        return [rows[i] for i in ids if i in rows]
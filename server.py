@@ -1,26 +1,58 @@
-from flask import Flask, request, jsonify, send_from_directory, Response
-from flask_cors import CORS
+from lazy_imports import import_timer, lazy, report_import_times
+with import_timer("flask"):
+    from flask import Flask, request, jsonify, send_from_directory, Response
+    from flask_cors import CORS
 import os
-import analyzer
-import agent_tools
-import geopandas as gpd
-import pandas as pd
+with import_timer("geopandas/pandas/shapely"):
+    import geopandas as gpd
+    import pandas as pd
+    import numpy as np
+    import shapely
+    from shapely.geometry import shape, box
+# One timer per module, leaves first so each only counts its own import
+with import_timer("hubs"):
+    import hubs
+with import_timer("topology"):
+    import topology
+with import_timer("parcel_stats"):
+    import parcel_stats
+with import_timer("address_index"):
+    import address_index
+with import_timer("parcel_store"):
+    import parcel_store  # also loads pyarrow, which the store and ?format=arrow use
+import pyarrow
+with import_timer("tiles"):
+    import tiles
+with import_timer("tile_archive"):
+    import tile_archive
 import json
-from shapely.geometry import shape
 import threading
+import functools
+import time
 import re
-from pypdf import PdfReader
-import google.generativeai as genai
-from dotenv import load_dotenv
+with import_timer("dotenv"):
+    from dotenv import load_dotenv
 import gzip
+import hashlib
+import math
+import zlib
 import gc
 
+# Heavy imports only needed by the agent, /upload and /api/upload-doc.
+# They load on first use so cold start / autoscale-up doesn't pay for them.
+analyzer = lazy("analyzer")              # rasterio, rasterstats
+agent_tools = lazy("agent_tools")        # requests
+pypdf = lazy("pypdf")
+genai = lazy("google.generativeai")
+
+report_import_times("Startup imports")
+
 load_dotenv()
 GEMINI_KEY = os.getenv("GEMINI_API_KEY")
 
 if GEMINI_KEY:
-    genai.configure(api_key=GEMINI_KEY)
-    print("Gemini Configured with Key", flush=True)
+    # genai.configure happens on first use, see analyze_with_gemini
+    print("Gemini Key found", flush=True)
 else:
     print("WARNING: No Gemini Key found", flush=True)
 
@@ -53,9 +85,8 @@ def analyze_with_gemini(file_path, mime_type, api_key=None):
     
     try:
         # Use Flash Latest (Stable)
-        # Configure specifically for this call if key provided
-        if api_key:
-            genai.configure(api_key=api_key)
+        # Configure for this call (form key or env key)
+        genai.configure(api_key=key_to_use)
             
         model = genai.GenerativeModel("gemini-flash-latest")
         
@@ -104,77 +135,259 @@ os.makedirs(DATA_DIR, exist_ok=True)
 BASE_GEOJSON = os.path.join(DATA_DIR, "analysis_73057.geojson")
 if not os.path.exists(BASE_GEOJSON):
     print("WARNING: Base analysis file missing. Please run main.py first.")
-    GLOBAL_GDF = None
-else:
-    print("Loading Global GeoDataFrame in memory...", flush=True)
-    
-    # List of files to load
-    # 73057: Brides
-    # 73284: Salins
-    # 73055: Bozel
-    # 73227: Courchevel
-    FILES = [
-        "analysis_73057.geojson", # Keep original with analysis
-        "cadastre_73057.json",    # Fallback/Base
-        "cadastre_73284.json",
-        "cadastre_73055.json",
-        "cadastre_73227.json"
-    ]
-    
-    gdfs = []
-    
-    # helper
-    def load_if_exists(fname):
-        p = os.path.join(DATA_DIR, fname)
-        if os.path.exists(p):
-            try:
-                print(f"Loading {fname}...", flush=True)
-                return gpd.read_file(p)
-            except Exception as e:
-                print(f"Error loading {fname}: {e}", flush=True)
-        return None
 
-    # 1. Load Main Analysis (Brides 73057)
-    # Prefer analysis file for 73057 if available, else raw
-    if os.path.exists(os.path.join(DATA_DIR, "analysis_73057.geojson")):
-        gdfs.append(load_if_exists("analysis_73057.geojson"))
-    else:
-        gdfs.append(load_if_exists("cadastre_73057.json"))
-        
-    # 2. Load Others
-    for f in ["cadastre_73284.json", "cadastre_73055.json", "cadastre_73227.json"]:
-        gdfs.append(load_if_exists(f))
-        
-    # Filter None
-    gdfs = [g for g in gdfs if g is not None]
-    
-    if gdfs:
-        GLOBAL_GDF = pd.concat(gdfs, ignore_index=True)
-        # Deduplicate
-        GLOBAL_GDF = GLOBAL_GDF.drop_duplicates(subset=['id'])
+# Communes are paged in from ./data/store the first time they are requested
+# (compiled by `python analyzer.py build-store`, or on first boot)
+# 73057: Brides
+# 73284: Salins
+# 73055: Bozel
+# 73227: Courchevel
+# COMMUNE_MEMORY_BUDGET_MB caps what stays resident (0 = keep everything once loaded)
+# PRELOAD_COMMUNES=73057,73227 warms those at boot instead of everything ("all", the
+# default: the page loads /api/parcels first thing), PRELOAD_COMMUNES=none skips it
+REGISTRY = parcel_store.CommuneRegistry(DATA_DIR, budget_mb=os.getenv("COMMUNE_MEMORY_BUDGET_MB", "0"))
+GLOBAL_GDF = None
+PAYLOADS = {}  # e.g. 'all.geojson', '73057_z12.topojson' -> (snapshot on disk, dataset version it holds)
+PAYLOAD_LOCKS = {}  # same keys -> lock held while that payload is being written
+TILE_CACHE = tiles.TileCache(int(os.getenv("TILE_CACHE_SIZE", "4096")))
+STATS = parcel_stats.ParcelStats()  # per commune/section aggregates behind /api/stats
+ADDRESSES = address_index.AddressIndex()  # trigram index behind /api/search/address
+# Pre-rendered pyramid from `python analyzer.py build-tiles`, used when present
+TILE_ARCHIVE = tile_archive.TileArchive(tile_archive.archive_path(DATA_DIR))
+
+# Set once the store is open and preloaded communes/caches are warm (see load_dataset)
+DATA_READY = threading.Event()
+LOAD_ERROR = None
+RETRY_AFTER_SECONDS = 5
+# /api/parcels/attributes default columns: what the filters, stats and search in index.html read
+ATTRIBUTE_FIELDS = ['id', 'total_area_sqm', 'contenance', 'slope_mean', 'address', 'buildable_area_sqm']
+ARROW_MIMETYPE = "application/vnd.apache.arrow.stream"
+# /api/parcels/query bounds: parameter -> (column, comparison). Rows where the
+# column is empty never match a bound, like SQL NULLs.
+QUERY_FILTERS = {
+    'min_area': ('total_area_sqm', np.greater_equal),
+    'max_slope': ('slope_mean', np.less_equal),
+    'min_buildable': ('buildable_area_sqm', np.greater_equal),
+    'max_price_m2': ('est_price_m2', np.less_equal),
+}
+QUERY_ID_LIMIT = 100000
+# /api/parcels/resolve: cited numbers per request
+RESOLVE_MAX_NUMBERS = 1000
+# /api/parcels/batch: ids per request
+BATCH_MAX_IDS = 5000
+# /api/parcels.ndjson: features serialized (and flushed) per chunk
+NDJSON_CHUNK = 500
+# /api/parcels?bbox= page size (default and hard cap)
+BBOX_LIMIT = 5000
+BBOX_MAX_LIMIT = 20000
+
+def _sync_journal():
+    # Caller holds DATA_LOCK. Every data route comes through here (directly or via _activate):
+    # pick up a store another worker rebuilt (/upload) or an analyzer run, then the
+    # enrichments written by this or other workers.
+    if REGISTRY.is_stale():
+        print("Inputs changed on disk, reloading parcel store...", flush=True)
+        _reload()
+    ids = REGISTRY.sync_journal()
+    if ids:
+        TILE_CACHE.clear()
+        # The archived tiles of those communes no longer match, render them live
+        TILE_ARCHIVE.mark_stale(set(parcel_store.commune_of(pd.Series(ids))))
+        STATS.update(REGISTRY.gdf, ids)
+        ADDRESSES.update(REGISTRY.gdf, ids, REGISTRY.positions(ids))
+    return ids
+
+def _activate(codes=None):
+    # Caller holds DATA_LOCK
+    global GLOBAL_GDF
+    _sync_journal()
+    loaded, evicted = REGISTRY.activate(REGISTRY.known() if codes is None else codes)
+    GLOBAL_GDF = REGISTRY.gdf
+    if loaded:
+        # Communes already indexed from their compiled files are up to date too
+        STATS.rebuild(GLOBAL_GDF, STATS.missing(loaded))
+        ADDRESSES.rebuild(GLOBAL_GDF, ADDRESSES.missing(loaded))
+    if loaded or evicted:
         print(f"Total Merged Parcels: {len(GLOBAL_GDF)}", flush=True)
-        
-        # FIX: Timestamp serialization error
-        # Convert all datetime objects to string
-        for col in GLOBAL_GDF.columns:
-            if pd.api.types.is_datetime64_any_dtype(GLOBAL_GDF[col]):
-                GLOBAL_GDF[col] = GLOBAL_GDF[col].astype(str)
-                print(f"Converted {col} to string", flush=True)
-        
-        # Pre-compute JSON for performance -> NOW SAVING TO DISK FOR MEMORY
-        print("Saving merged GeoJSON to disk...", flush=True)
-        MERGED_FILE = os.path.join(DATA_DIR, "merged_parcels.json")
-        if os.path.exists(MERGED_FILE):
-             os.remove(MERGED_FILE)
-        
-        GLOBAL_GDF.to_file(MERGED_FILE, driver="GeoJSON")
-        print(f"Merged GeoJSON saved to {MERGED_FILE}", flush=True)
-        
+        if GLOBAL_GDF is not None:
+            # Build the STRtree and the id/reference indexes now, once per merged frame, rather than in the first request
+            GLOBAL_GDF.sindex
+            REGISTRY.rows()
+            REGISTRY.refs()
         # Optimize Memory: Force GC
         gc.collect()
-    else:
-        print("CRITICAL: No data loaded!", flush=True)
-        GLOBAL_GDF = None
+
+def _summarize(codes):
+    # Caller holds DATA_LOCK. Communes that aren't loaded get their compiled aggregates
+    # (parcel_store.write_indexes) rather than being paged in, or for a commune the
+    # journal has touched since, aggregates of its attribute columns (still no geometries)
+    missing = STATS.missing(codes)
+    if REGISTRY.manifest is None:
+        _activate(missing)
+        STATS.rebuild(GLOBAL_GDF, STATS.missing(codes))
+        return
+    loaded = set(REGISTRY.loaded())
+    STATS.rebuild(GLOBAL_GDF, [c for c in missing if c in loaded])
+    enriched = {i[:5] for i in REGISTRY.changes}
+    for code in missing:
+        if code in loaded:
+            continue
+        if code in enriched:
+            rows = parcel_store.read_attributes(DATA_DIR, REGISTRY.manifest, code, parcel_stats.COLUMNS)
+            STATS.rebuild(parcel_store.apply_enrichments(rows, parcel_store.read_enrichments(DATA_DIR, code)), [code])
+        else:
+            STATS.load(code, parcel_store.read_stats(DATA_DIR, REGISTRY.manifest, code))
+
+def _index_addresses(codes):
+    # Caller holds DATA_LOCK. Same for ADDRESSES: communes that aren't loaded are
+    # indexed from their compiled postings, with the journal's addresses replayed
+    missing = ADDRESSES.missing(codes)
+    if REGISTRY.manifest is None:
+        _activate(missing)  # no store on disk: everything is resident anyway
+        return
+    loaded = set(REGISTRY.loaded())
+    ADDRESSES.rebuild(GLOBAL_GDF, [c for c in missing if c in loaded])
+    for code in missing:
+        if code not in loaded:
+            table, postings = parcel_store.read_address_index(DATA_DIR, REGISTRY.manifest, code)
+            ADDRESSES.load(code, table, postings, parcel_store.read_enrichments(DATA_DIR, code))
+
+def _reload():
+    # Caller holds DATA_LOCK. Inputs changed on disk: recompile the store and reload.
+    global GLOBAL_GDF
+    REGISTRY.reload()
+    GLOBAL_GDF = REGISTRY.gdf
+    PAYLOADS.clear()
+    TILE_CACHE.clear()
+    STATS.clear()
+    STATS.rebuild(GLOBAL_GDF, REGISTRY.loaded())
+    ADDRESSES.clear()
+    ADDRESSES.rebuild(GLOBAL_GDF, REGISTRY.loaded())
+    TILE_ARCHIVE.open(DATA_DIR, REGISTRY.manifest)
+
+def parcels_payload(commune=None, level=None, fmt="geojson"):
+    """
+    Path of the serialized GeoJSON (or TopoJSON) for one commune (or all of them),
+    at full detail or at LOD `level`.
+    Reuses the snapshot on disk when the inputs haven't changed, so a fresh
+    worker can serve it without even loading the commune.
+    Returns (path, dataset version); clients catch up with /api/parcels/changes.
+    """
+    key = (commune or "all") + (f"_z{level}" if level else "")
+    # One writer per payload: other requests for it wait here for the file, not on DATA_LOCK
+    with PAYLOAD_LOCKS.setdefault(f"{key}.{fmt}", threading.Lock()):
+        with DATA_LOCK:
+            # Reloads the store first if the inputs changed on disk (PAYLOADS is cleared then)
+            _sync_journal()
+            cached = PAYLOADS.get(f"{key}.{fmt}")
+            if cached and os.path.exists(cached[0]):
+                return cached
+
+            # Version first: a record landing in between makes it stale by one, never ahead
+            version = REGISTRY.version
+            snapshot = REGISTRY.snapshot()
+            path = parcel_store.payload_path(DATA_DIR, key, snapshot, fmt)
+            if os.path.exists(path):
+                PAYLOADS[f"{key}.{fmt}"] = (path, version)
+                return PAYLOADS[f"{key}.{fmt}"]
+
+            _activate([commune] if commune else None)
+            if GLOBAL_GDF is None:
+                return None, None
+            subset = GLOBAL_GDF
+            if commune:
+                subset = subset[parcel_store.commune_of(subset['id']) == commune]
+            if level:
+                # Low zooms only draw and filter: sub-pixel parcels and most properties are left out
+                rows = np.flatnonzero((parcel_store.commune_of(GLOBAL_GDF['id']) == commune).to_numpy()) \
+                    if commune else np.arange(len(GLOBAL_GDF))
+                lod = REGISTRY.lod(level)
+                rows = rows[parcel_store.lod_visible(lod[rows], level)]
+                subset = parcel_store.lod_frame(GLOBAL_GDF, lod, rows)
+            if subset is GLOBAL_GDF:
+                # The journal writes into GLOBAL_GDF in place: serialize a frame of our own
+                subset = subset.copy()
+            version = REGISTRY.version
+
+        # Serializing and compressing take seconds for 'all': keep the other routes answering
+        print(f"Saving {key} {fmt} snapshot {snapshot} to disk...", flush=True)
+        parcel_store.write_payload(subset, DATA_DIR, key, snapshot, fmt)
+        with DATA_LOCK:
+            if REGISTRY.snapshot() == snapshot:
+                PAYLOADS[f"{key}.{fmt}"] = (path, version)
+        return path, version
+
+def load_dataset():
+    """
+    Opens the parcel store, loads the preloaded communes and warms their payloads,
+    then flags the worker as ready. Runs in a background thread so Flask/gunicorn
+    can bind the port (and answer /healthz) while this is going on.
+    """
+    global LOAD_ERROR
+    t0 = time.time()
+    try:
+        with DATA_LOCK:
+            print("Opening parcel store...", flush=True)
+            REGISTRY.open()
+            print(f"Communes available: {', '.join(REGISTRY.known()) or 'none'}", flush=True)
+            TILE_ARCHIVE.open(DATA_DIR, REGISTRY.manifest)
+
+        # The GeoJSON the page asks for on load; from a snapshot on disk this doesn't even
+        # load the communes. TopoJSON and LOD payloads are written on first request.
+        preload = os.getenv("PRELOAD_COMMUNES", "all")
+        if preload == "all":
+            parcels_payload()
+        elif preload != "none":
+            for code in preload.split(","):
+                parcels_payload(code)
+        gc.collect()
+
+        DATA_READY.set()
+        print(f"Dataset ready in {time.time() - t0:.1f}s", flush=True)
+    except Exception as e:
+        LOAD_ERROR = str(e)
+        print(f"CRITICAL: Dataset load failed: {e}", flush=True)
+
+# Bind first and load in the background, /readyz says when it's done. Each gunicorn
+# worker loads its own copy of the communes it serves; what workers do share is the
+# memory-mapped store files (through the page cache) and the enrichment journal,
+# and the store build lock makes a cold store compile once.
+threading.Thread(target=load_dataset, name="parcel-loader", daemon=True).start()
+
+def requires_data(f):
+    """Data routes answer a fast 503 + Retry-After until the dataset is loaded."""
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        if not DATA_READY.is_set():
+            res = jsonify({"error": "Parcel data is still loading, retry shortly",
+                           "status": "error" if LOAD_ERROR else "loading"})
+            res.status_code = 503
+            res.headers["Retry-After"] = str(RETRY_AFTER_SECONDS)
+            return res
+        return f(*args, **kwargs)
+    return wrapper
+
+@app.route("/healthz")
+def healthz():
+    # Liveness: the process is up and serving HTTP
+    return jsonify({"status": "ok"})
+
+@app.route("/readyz")
+def readyz():
+    # Readiness: dataset loaded and caches warm, safe to route traffic here
+    if not DATA_READY.is_set():
+        res = jsonify({"status": "error" if LOAD_ERROR else "loading", "error": LOAD_ERROR})
+        res.status_code = 503
+        res.headers["Retry-After"] = str(RETRY_AFTER_SECONDS)
+        return res
+    return jsonify({
+        "status": "ready",
+        "communes": REGISTRY.known(),
+        "communes_loaded": REGISTRY.loaded(),
+        "parcels_loaded": 0 if GLOBAL_GDF is None else len(GLOBAL_GDF),
+        "payloads_cached": sorted(PAYLOADS),
+        "version": REGISTRY.version
+    })
 
 @app.route("/")
 def serve_index():
@@ -182,13 +395,453 @@ def serve_index():
 
 @app.route("/data/<path:filename>")
 def serve_data(filename):
+    # send_file answers Range requests (206), which is all FlatGeobuf readers need
+    # to fetch a bbox from /data/store/parcels.fgb
     return send_from_directory("data", filename)
 
 @app.route("/api/parcels")
+@requires_data
 def api_parcels():
-    return send_from_directory(DATA_DIR, "merged_parcels.json")
+    # ?commune=73057 only loads and ships that commune
+    commune = request.args.get('commune')
+    if commune and commune not in REGISTRY.known():
+        return jsonify({"error": f"Unknown commune {commune}"}), 404
+    # ?zoom=12 or ?tolerance=<degrees> serves simplified geometries (see parcel_store.LOD_ZOOMS),
+    # without sub-pixel parcels and with only the properties the map styles read
+    level = parcel_store.lod_level(request.args.get('zoom', type=float),
+                                   request.args.get('tolerance', type=float))
+    # ?format=topojson: shared arcs, delta-encoded integer coordinates
+    fmt = request.args.get('format', 'geojson')
+    if fmt not in parcel_store.PAYLOAD_FORMATS:
+        return jsonify({"error": f"format must be one of {', '.join(parcel_store.PAYLOAD_FORMATS)}"}), 400
+    if request.args.get('bbox'):
+        return parcels_in_bbox(request.args.get('bbox'), commune, level, fmt)
+    path, version = parcels_payload(commune, level, fmt)
+    if path is None:
+        return jsonify({"error": "No data loaded"}), 500
+    return send_payload(path, version)
+
+def send_payload(path, version):
+    """
+    Serves a payload snapshot, precompressed when the client accepts it.
+    The ETag is the snapshot file name (commune + dataset version + encoding), so
+    it only changes with the data and revalidation answers 304.
+    """
+    name = os.path.basename(path)
+    encoding = None
+    for enc, suffix in parcel_store.PAYLOAD_ENCODINGS:
+        if enc in request.accept_encodings and os.path.exists(path + suffix):
+            encoding, name = enc, name + suffix
+            break
+    resp = send_from_directory(os.path.dirname(path), name, mimetype='application/json',
+                               etag=name, conditional=True)
+    if encoding:
+        resp.headers["Content-Encoding"] = encoding
+    resp.headers["Vary"] = "Accept-Encoding"
+    # Cacheable, but always revalidated so a new dataset version shows up immediately
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Dataset-Version"] = str(version)
+    return resp
+
+def parcels_in_bbox(bbox, commune=None, level=None, fmt="geojson"):
+    """
+    ?bbox=w,s,e,n&limit=N: parcels intersecting the viewport, from the spatial index.
+    X-Total-Count / X-Truncated tell the client whether the page was cut at limit.
+    """
+    try:
+        w, s, e, n = [float(v) for v in bbox.split(",")]
+        limit = min(int(request.args.get('limit', BBOX_LIMIT)), BBOX_MAX_LIMIT)
+    except ValueError:
+        return jsonify({"error": "bbox must be w,s,e,n in degrees and limit an integer"}), 400
+    if not all(math.isfinite(v) for v in (w, s, e, n)):
+        return jsonify({"error": "bbox values must be finite numbers"}), 400
+    if not (-180 <= w <= e <= 180 and -90 <= s <= n <= 90) or limit < 1:
+        return jsonify({"error": "Invalid bbox (lon -180..180, lat -90..90, w <= e, s <= n) or limit"}), 400
+
+    with DATA_LOCK:
+        _sync_journal()
+        codes = REGISTRY.intersecting((w, s, e, n))
+        if commune:
+            codes = [c for c in codes if c == commune]
+        _activate(codes)
+        gdf = GLOBAL_GDF
+        lod = REGISTRY.lod(level) if level else None
+
+    hits = []
+    if gdf is not None and codes:
+        hits = gdf.sindex.query(box(w, s, e, n), predicate="intersects")
+        hits.sort()
+        if commune:
+            hits = hits[(parcel_store.commune_of(gdf['id'].iloc[hits]) == commune).to_numpy()]
+    if len(hits) and lod is not None:
+        hits = hits[parcel_store.lod_visible(lod[hits], level)]
+    total = len(hits)
+    if not total:
+        subset = gpd.GeoDataFrame(geometry=[], crs="EPSG:4326")
+    elif lod is not None:
+        subset = parcel_store.lod_frame(gdf, lod, hits[:limit])
+    else:
+        subset = gdf.iloc[hits[:limit]]
+    if fmt == "topojson":
+        body = topology.to_topojson(subset, parcel_store.COORD_PRECISION)
+    else:
+        body = subset.to_json(drop_id=True)
+    return Response(body, mimetype='application/json', headers={
+        "X-Total-Count": str(total),
+        "X-Truncated": "1" if total > limit else "0",
+    })
+
+@app.route("/api/hubs")
+def api_hubs():
+    # The hub table the map uses for labels (distances ship precomputed as dist_to_hub)
+    return jsonify(hubs.HUBS)
+
+@app.route("/api/stats")
+@requires_data
+def api_stats():
+    """
+    Precomputed aggregates: parcel count, total/mean area, slope and price
+    quantiles and histograms. ?commune= gives that commune with its sections,
+    otherwise every commune plus dataset totals.
+    """
+    commune = request.args.get('commune')
+    if commune and commune not in REGISTRY.known():
+        return jsonify({"error": f"Unknown commune {commune}"}), 404
+    codes = [commune] if commune else REGISTRY.known()
+    with DATA_LOCK:
+        _sync_journal()
+        _summarize(codes)
+        version = REGISTRY.version
+        if commune:
+            return jsonify({"commune": commune, "version": version, **STATS.communes.get(commune, {})})
+        communes = {c: {k: v for k, v in STATS.communes[c].items() if k != "sections"}
+                    for c in codes if c in STATS.communes}
+        return jsonify({"version": version, "totals": STATS.totals(), "communes": communes})
+
+@app.route("/api/search/address")
+@requires_data
+def api_search_address():
+    """
+    Address autocomplete: ?q=&limit= -> {"results": [{"id", "address", "bbox"}]}.
+    Answered from the address index, whether or not the client has the parcels.
+    """
+    q = request.args.get('q', '').strip()
+    limit = min(max(request.args.get('limit', address_index.SEARCH_LIMIT, type=int), 1), 50)
+    if not q:
+        return jsonify({"query": q, "results": []})
+    with DATA_LOCK:
+        _sync_journal()
+        _index_addresses(REGISTRY.known())
+        results = ADDRESSES.search(q, limit)
+        version = REGISTRY.version
+    return jsonify({"query": q, "version": version, "results": results})
+
+@app.route("/api/parcels/query")
+@requires_data
+def api_parcel_query():
+    """
+    Server-side filtering: ?commune=&min_area=&max_slope=&min_buildable=&max_price_m2=&limit=
+    evaluated as boolean masks over the loaded columns.
+    Returns {"count", "truncated", "ids"}, or the features with ?output=features.
+    """
+    commune = request.args.get('commune')
+    if commune and commune not in REGISTRY.known():
+        return jsonify({"error": f"Unknown commune {commune}"}), 404
+    output = request.args.get('output', 'ids')
+    if output not in ("ids", "features"):
+        return jsonify({"error": "output must be ids or features"}), 400
+    bounds = {}
+    try:
+        for param in QUERY_FILTERS:
+            if request.args.get(param) not in (None, ""):
+                bounds[param] = float(request.args[param])
+        default_limit = QUERY_ID_LIMIT if output == "ids" else BBOX_LIMIT
+        limit = int(request.args.get('limit', default_limit))
+    except ValueError:
+        return jsonify({"error": "Filter bounds must be numbers and limit an integer"}), 400
+    limit = min(limit, QUERY_ID_LIMIT if output == "ids" else BBOX_MAX_LIMIT)
+
+    with DATA_LOCK:
+        _activate([commune] if commune else None)
+        gdf = GLOBAL_GDF
+        version = REGISTRY.version
+    if gdf is None:
+        return jsonify({"error": "No data loaded"}), 500
+
+    mask = np.ones(len(gdf), dtype=bool)
+    if commune:
+        mask &= (parcel_store.commune_of(gdf['id']) == commune).to_numpy()
+    for param, value in bounds.items():
+        column, compare = QUERY_FILTERS[param]
+        if column not in gdf.columns:
+            mask[:] = False
+            break
+        values = pd.to_numeric(gdf[column], errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+        mask &= compare(values, value)  # NaN compares False
+
+    rows = np.flatnonzero(mask)
+    result = {"count": int(len(rows)), "truncated": bool(len(rows) > limit), "version": version}
+    rows = rows[:max(limit, 0)]
+    if output == "ids":
+        result["ids"] = gdf['id'].to_numpy()[rows].tolist()
+    else:
+        result["type"] = "FeatureCollection"
+        result["features"] = list(gdf.iloc[rows].iterfeatures(na='null', drop_id=True))
+    return jsonify(result)
+
+@app.route("/api/parcels/batch", methods=["POST"])
+@requires_data
+def api_parcel_batch():
+    """
+    Features for a list of ids: {"ids": [...]} -> FeatureCollection in the order given.
+    Rows come from the id index and are serialized in one to_json pass;
+    X-Missing-Count says how many ids weren't found.
+    """
+    body = request.get_json(silent=True) or {}
+    ids = body.get('ids') if isinstance(body, dict) else body
+    if not isinstance(ids, list) or not all(isinstance(i, str) for i in ids):
+        return jsonify({"error": "Expected {\"ids\": [parcel ids]}"}), 400
+    if len(ids) > BATCH_MAX_IDS:
+        return jsonify({"error": f"At most {BATCH_MAX_IDS} ids per request"}), 400
+    ids = list(dict.fromkeys(ids))
+
+    with DATA_LOCK:
+        _sync_journal()
+        codes = sorted({i[:5] for i in ids} & set(REGISTRY.known()))
+        if codes:
+            _activate(codes)
+        rows = REGISTRY.positions(ids) if codes else []
+        subset = GLOBAL_GDF.iloc[rows] if rows else gpd.GeoDataFrame(geometry=[], crs="EPSG:4326")
+        version = REGISTRY.version
+    return Response(subset.to_json(drop_id=True), mimetype='application/json', headers={
+        "X-Missing-Count": str(len(ids) - len(rows)),
+        "X-Dataset-Version": str(version),
+    })
+
+def _valid_reference(q):
+    numbers = q.get('numbers')
+    return (isinstance(q.get('commune_code'), (str, type(None)))
+            and isinstance(q.get('section'), (str, type(None)))
+            and isinstance(numbers, (list, type(None)))
+            # a bare string would be resolved one digit at a time
+            and all(isinstance(n, (str, int)) and not isinstance(n, bool) for n in numbers or []))
+
+@app.route("/api/parcels/resolve", methods=["POST"])
+@requires_data
+def api_parcel_resolve():
+    """
+    Cadastral references (as /api/upload-doc extracts them) to parcels, in one round trip.
+    Body: [{"commune_code", "section", "numbers": [...]}, ...] (or a single such object).
+    Each number gets its "exact" ids, or "fuzzy" near misses when there is none;
+    every parcel mentioned comes once in "features".
+    """
+    queries = request.get_json(silent=True)
+    if isinstance(queries, dict):
+        queries = [queries]
+    if not isinstance(queries, list) or not all(isinstance(q, dict) and _valid_reference(q) for q in queries):
+        return jsonify({"error": "Expected a list of {commune_code: str|null, section: str|null, "
+                                 "numbers: [str|int]}"}), 400
+    if sum(len(q.get('numbers') or []) for q in queries) > RESOLVE_MAX_NUMBERS:
+        return jsonify({"error": f"At most {RESOLVE_MAX_NUMBERS} numbers per request"}), 400
+    known = REGISTRY.known()
+    codes = {q.get('commune_code') for q in queries}
+    # Unknown or missing commune: look everywhere
+    codes = None if None in codes or not codes <= set(known) else sorted(codes)
+
+    with DATA_LOCK:
+        _activate(codes)
+        if GLOBAL_GDF is None:
+            return jsonify({"error": "No data loaded"}), 500
+        refs = REGISTRY.refs()
+        ids = GLOBAL_GDF['id'].to_numpy()
+        results, rows = [], {}
+        for q in queries:
+            commune = q.get('commune_code') if q.get('commune_code') in known else None
+            for number in q.get('numbers') or []:
+                exact, fuzzy = refs.resolve(number, q.get('section'), commune)
+                rows.update(dict.fromkeys(exact + fuzzy))
+                results.append({"commune_code": commune, "section": q.get('section'), "number": number,
+                                "exact": ids[exact].tolist(), "fuzzy": ids[fuzzy].tolist()})
+        features = list(GLOBAL_GDF.iloc[list(rows)].iterfeatures(na='null', drop_id=True))
+        version = REGISTRY.version
+    return jsonify({"type": "FeatureCollection", "version": version, "results": results, "features": features})
+
+@app.route("/api/parcels/changes")
+@requires_data
+def api_parcel_changes():
+    """
+    Parcels changed after dataset version ?since= (see X-Dataset-Version on /api/parcels),
+    as a FeatureCollection with the current version to pass next time.
+    "reset": true means the client's version is unknown here, or older than the last
+    store rebuild (upload, analyzer run), and it should reload.
+    """
+    since = request.args.get('since', type=int)
+    if since is None or since < 0:
+        return jsonify({"error": "since must be a dataset version (integer)"}), 400
+    commune = request.args.get('commune')
+
+    with DATA_LOCK:
+        _sync_journal()
+        version = REGISTRY.version
+        # A rebuild may have rewritten any row, which the change log can't list
+        reset = since > version or since < REGISTRY.rebuilt_at
+        ids = [] if reset else REGISTRY.changed_since(since)
+        if commune:
+            ids = [i for i in ids if i.startswith(commune)]
+        features = []
+        if ids:
+            _activate(sorted({i[:5] for i in ids}))
+            changed = GLOBAL_GDF.iloc[REGISTRY.positions(ids)]
+            features = list(changed.iterfeatures(na='null', drop_id=True))
+
+    return jsonify({
+        "type": "FeatureCollection",
+        "version": version,
+        "since": since,
+        "reset": reset,
+        "features": features,
+    })
+
+@app.route("/api/parcels.ndjson")
+@requires_data
+def api_parcels_ndjson():
+    """
+    One GeoJSON feature per line, nearest to the commune's hub first, streamed in
+    chunks so the client can draw while the rest is still coming.
+    Accepts ?commune= and ?zoom= / ?tolerance= like /api/parcels.
+    """
+    commune = request.args.get('commune')
+    if commune and commune not in REGISTRY.known():
+        return jsonify({"error": f"Unknown commune {commune}"}), 404
+    level = parcel_store.lod_level(request.args.get('zoom', type=float),
+                                   request.args.get('tolerance', type=float))
+
+    with DATA_LOCK:
+        _activate([commune] if commune else None)
+        gdf = GLOBAL_GDF
+        lod = REGISTRY.lod(level) if level else None
+    if gdf is None:
+        return jsonify({"error": "No data loaded"}), 500
+
+    rows = np.arange(len(gdf))
+    if commune:
+        rows = rows[(parcel_store.commune_of(gdf['id']) == commune).to_numpy()]
+    if lod is not None:
+        rows = rows[parcel_store.lod_visible(lod[rows], level)]
+    # Outward from the hub (equirectangular distance is plenty to sort by)
+    hub_lon, hub_lat = hubs.get_hub(commune)['coords']
+    centers = shapely.centroid(gdf.geometry.values[rows])
+    dx = (shapely.get_x(centers) - hub_lon) * math.cos(math.radians(hub_lat))
+    dy = shapely.get_y(centers) - hub_lat
+    rows = rows[np.argsort(dx * dx + dy * dy, kind="stable")]
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if 'gzip' in request.accept_encodings else None
+
+    def generate():
+        for i in range(0, len(rows), NDJSON_CHUNK):
+            if lod is not None:
+                chunk = parcel_store.lod_frame(gdf, lod, rows[i:i + NDJSON_CHUNK])
+            else:
+                chunk = gdf.iloc[rows[i:i + NDJSON_CHUNK]]
+            lines = "".join(json.dumps(f, separators=(',', ':')) + "\n"
+                            for f in chunk.iterfeatures(na='null', drop_id=True)).encode()
+            # Sync-flush each chunk so gzip doesn't hold it back
+            yield (compressor.compress(lines) + compressor.flush(zlib.Z_SYNC_FLUSH)) if compressor else lines
+        if compressor:
+            yield compressor.flush()
+
+    headers = {"X-Total-Count": str(len(rows)), "Vary": "Accept-Encoding", "X-Accel-Buffering": "no"}
+    if compressor:
+        headers["Content-Encoding"] = "gzip"
+    return Response(generate(), mimetype='application/x-ndjson', headers=headers)
+
+@app.route("/api/parcels/attributes")
+@requires_data
+def api_parcel_attributes():
+    """
+    Properties only, column-oriented: {"count": n, "columns": {field: [values...]}}.
+    ?fields=id,slope_mean picks the columns, ?commune= restricts the rows and
+    ?format=arrow returns the same table as an Arrow IPC stream.
+    """
+    commune = request.args.get('commune')
+    if commune and commune not in REGISTRY.known():
+        return jsonify({"error": f"Unknown commune {commune}"}), 404
+    fmt = request.args.get('format', 'json')
+    if fmt not in ("json", "arrow"):
+        return jsonify({"error": "format must be json or arrow"}), 400
+
+    with DATA_LOCK:
+        _activate([commune] if commune else None)
+        gdf = GLOBAL_GDF
+        snapshot = REGISTRY.snapshot()
+    if gdf is None:
+        return jsonify({"error": "No data loaded"}), 500
+
+    fields = request.args.get('fields')
+    fields = fields.split(",") if fields else ATTRIBUTE_FIELDS
+    unknown = [f for f in fields if f not in gdf.columns or f == gdf.geometry.name]
+    if unknown:
+        return jsonify({"error": f"Unknown fields: {', '.join(unknown)}"}), 400
+
+    # Same dataset version + same query -> same bytes, so revalidation needs no work
+    encoding = "gzip" if "gzip" in request.accept_encodings else None
+    query = hashlib.blake2b(request.query_string, digest_size=6).hexdigest()
+    etag = f"attributes.{snapshot}.{query}.{encoding or 'identity'}"
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={"ETag": f'"{etag}"', "Vary": "Accept-Encoding"})
+
+    frame = gdf[fields]
+    if commune:
+        frame = frame[parcel_store.commune_of(gdf['id']) == commune]
+    if fmt == "arrow":
+        table = pyarrow.Table.from_pandas(pd.DataFrame(frame), preserve_index=False)
+        sink = pyarrow.BufferOutputStream()
+        with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        body, mimetype = sink.getvalue().to_pybytes(), ARROW_MIMETYPE
+    else:
+        columns = {f: frame[f].astype(object).where(frame[f].notna(), None).tolist() for f in fields}
+        body, mimetype = json.dumps({"count": len(frame), "columns": columns}, separators=(',', ':')), 'application/json'
+
+    if encoding:
+        body = gzip.compress(body.encode() if isinstance(body, str) else body, compresslevel=6)
+    resp = Response(body, mimetype=mimetype)
+    if encoding:
+        resp.headers["Content-Encoding"] = encoding
+    resp.headers["Vary"] = "Accept-Encoding"
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.set_etag(etag)
+    return resp
+
+@app.route("/api/tiles/<int:z>/<int:x>/<int:y>.mvt")
+@requires_data
+def api_tile(z, x, y):
+    # Parcels as Mapbox Vector Tiles (source-layer "parcels"), simplified per zoom
+    if not tiles.valid_tile(z, x, y):
+        return jsonify({"error": "Invalid tile"}), 404
+
+    with DATA_LOCK:
+        _sync_journal()
+        codes = REGISTRY.intersecting(tiles.tile_bbox(z, x, y, tiles.TILE_BUFFER))
+        archived = TILE_ARCHIVE.covers(z, codes)
+        if not archived:
+            # Only page in the communes this tile actually touches
+            _activate(codes)
+            gdf = GLOBAL_GDF
+            level = parcel_store.lod_level(zoom=z)
+            lod = REGISTRY.lod(level) if level else None
+    if archived:
+        data = TILE_ARCHIVE.get(z, x, y)
+        return Response(data, mimetype=tiles.MIMETYPE, headers={"Cache-Control": "public, max-age=300"})
+
+    data = TILE_CACHE.get((z, x, y))
+    if data is None:
+        data = tiles.render_tile(gdf, z, x, y, geoms=lod)
+        TILE_CACHE.put((z, x, y), data)
+    return Response(data, mimetype=tiles.MIMETYPE, headers={"Cache-Control": "public, max-age=300"})
 
 @app.route("/agent/fetch-parcel-data", methods=["POST"])
+@requires_data
 def agent_fetch():
     data = request.json
     parcel_id = data.get('id')
@@ -202,17 +855,20 @@ def agent_fetch():
         # gdf = gpd.read_file(BASE_GEOJSON) <-- REPLACED WITH GLOBAL
         
         with DATA_LOCK:
+            # Page in the parcel's commune if nobody asked for it yet
+            _activate([parcel_id[:5]])
             if GLOBAL_GDF is None:
                  return jsonify({"error": "Server not initialized with data"}), 500
 
-            # Find Parcel
-            # Check if ID exists (column might be string or obj)
-            target = GLOBAL_GDF[GLOBAL_GDF['id'] == parcel_id]
-            if target.empty:
+            # Find Parcel (id index: a dict lookup, not a scan of the id column)
+            row = REGISTRY.row(parcel_id)
+            if row is None:
                 return jsonify({"error": "Parcel not found"}), 404
                 
-            geom = target.iloc[0].geometry
-            idx = target.index[0]
+            geom = GLOBAL_GDF.geometry.iat[row]
+            # Same point the precomputed dist_to_hub was measured from (parcel_store.derive_columns)
+            lon = float(GLOBAL_GDF['center_lon'].iat[row])
+            lat = float(GLOBAL_GDF['center_lat'].iat[row])
             
             # Release lock while doing external IO (Agent Tools) if possible?
             # actually geom is copied, so we can release lock if we want, 
@@ -226,28 +882,36 @@ def agent_fetch():
             # Optimality: Compute outside lock, Write inside lock.
             
         # --- AGENT ACTION (Outside Lock for concurrency) ---
-        slope, elevation = agent_tools.compute_slope(geom)
         owner_status, request_text, owner_email = agent_tools.get_owner_info(parcel_id)
         
         # New Enrichments
-        centroid = geom.centroid
-        lat, lon = centroid.y, centroid.x
-        
-        address = agent_tools.get_address(lat, lon)
-        dist, hub_name = agent_tools.get_transport_info(lat, lon)
-        price_m2 = agent_tools.get_land_price_estimate(lat, lon)
+        # External providers all at once (see agent_tools.run_providers)
+        results, timings, late = agent_tools.run_providers({
+            'slope': (agent_tools.compute_slope, (geom,), (None, None)),
+            'address': (agent_tools.get_address, (lat, lon), None),
+            'price': (agent_tools.get_land_price_estimate, (lat, lon), None),
+        })
+        slope, elevation = results['slope']
+        address = results['address']
+        price_m2 = results['price']
+        dist, hub_name = agent_tools.get_transport_info(lat, lon, parcel_id[:5])
+        print(f"Agent providers for {parcel_id}: {timings}" + (f" (late: {', '.join(late)})" if late else ""), flush=True)
         
         if slope is not None:
             # Update GDF (Acquire Lock again)
             with DATA_LOCK:
-                # Re-verify index just in case? 
-                GLOBAL_GDF.at[idx, 'slope_mean'] = slope
-                GLOBAL_GDF.at[idx, 'address'] = address
-                GLOBAL_GDF.at[idx, 'dist_to_hub'] = dist
-                GLOBAL_GDF.at[idx, 'est_price_m2'] = price_m2
-                
-                # Save incrementally
-                GLOBAL_GDF.to_file(BASE_GEOJSON, driver='GeoJSON')
+                fields = {
+                    'slope_mean': slope,
+                    'address': address,
+                    'dist_to_hub': dist,
+                    'est_price_m2': price_m2
+                }
+                # Save incrementally: append to the enrichment journal instead of
+                # rewriting the analysis file (GLOBAL_GDF may only hold some communes).
+                # The journal is also the write path back to the shared dataset:
+                # this worker applies it now, the others on their next request.
+                parcel_store.append_enrichment(DATA_DIR, parcel_id, fields)
+                _sync_journal()
             
             return jsonify({
                 "message": "Agent analysis complete.",
@@ -261,16 +925,20 @@ def agent_fetch():
                 "hub_name": hub_name,
                 "est_price_m2": price_m2,
                 "center_lat": lat,
-                "center_lon": lon
+                "center_lon": lon,
+                "timings_ms": timings,
+                "timed_out": late
             })
         else:
-             return jsonify({"error": "Agent failed to fetch external data."}), 502
+             return jsonify({"error": "Agent failed to fetch external data.",
+                             "timings_ms": timings, "timed_out": late}), 502
              
     except Exception as e:
         print(f"Agent Error: {e}")
         return jsonify({"error": str(e)}), 500
 
 @app.route("/upload", methods=["POST"])
+@requires_data
 def upload_file():
     if 'file' not in request.files:
         return jsonify({"error": "No file part"}), 400
@@ -311,9 +979,9 @@ def upload_file():
                 owners_path=save_path if file_type=='owners' else None
             )
             with DATA_LOCK:
-                 # Reload Global Data since file changed on disk
-                 global GLOBAL_GDF
-                 GLOBAL_GDF = gpd.read_file(BASE_GEOJSON)
+                 # Reload Global Data since file changed on disk (recompiles the store)
+                 parcel_store.invalidate_snapshots(DATA_DIR)
+                 _reload()
                  
             return jsonify({"message": f"File uploaded and analysis updated!", "path": new_geojson_path})
         except Exception as e:
@@ -442,7 +1110,7 @@ def upload_doc():
         # Fallback for PDF Text
         if file_lower.endswith('.pdf'):
             try:
-                reader = PdfReader(save_path)
+                reader = pypdf.PdfReader(save_path)
                 text = ""
                 for page in reader.pages:
                     text += page.extract_text() or ""
@@ -0,0 +1,221 @@
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+import parcel_store
+import tiles
+
+# Pre-rendered parcel tile pyramid in a single MBTiles (SQLite) file.
+# Built offline by `python analyzer.py build-tiles`; the server then answers
+# tile requests with an indexed lookup and no geometry work.
+# Each commune's content fingerprint is stored in the archive so a rebuild only
+# re-renders the tiles touched by communes that actually changed.
+ARCHIVE_NAME = "parcels.mbtiles"
+MIN_ZOOM = 10
+MAX_ZOOM = 18
+
+
+def archive_path(data_dir):
+    return os.path.join(parcel_store.store_dir(data_dir), ARCHIVE_NAME)
+
+
+def _connect(path):
+    con = sqlite3.connect(path)
+    con.executescript("""
+        CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS tiles (
+            zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB,
+            PRIMARY KEY (zoom_level, tile_column, tile_row));
+        -- which tiles each commune has parcels in, to know what to redo when it changes
+        CREATE TABLE IF NOT EXISTS commune_tiles (
+            commune TEXT, zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER);
+        CREATE INDEX IF NOT EXISTS commune_tiles_idx ON commune_tiles (commune);
+    """)
+    return con
+
+
+def _tms_row(z, y):
+    # MBTiles stores rows bottom-up (TMS)
+    return (2 ** z - 1) - y
+
+
+def covering_tiles(gdf, z):
+    """Set of (x, y) tiles at zoom z overlapped by the bounding box of any parcel."""
+    b = gdf.geometry.bounds
+    n = 2 ** z
+    x0 = np.floor((b['minx'].to_numpy() + 180.0) / 360.0 * n).astype(int)
+    x1 = np.floor((b['maxx'].to_numpy() + 180.0) / 360.0 * n).astype(int)
+
+    def ty(lat):
+        r = np.radians(lat)
+        return np.floor((1.0 - np.log(np.tan(r) + 1.0 / np.cos(r)) / math.pi) / 2.0 * n).astype(int)
+
+    y0 = ty(b['maxy'].to_numpy())
+    y1 = ty(b['miny'].to_numpy())
+    out = set()
+    for a, b_, c, d in set(zip(x0, x1, y0, y1)):
+        for x in range(a, b_ + 1):
+            for y in range(c, d + 1):
+                out.add((x, y))
+    return out
+
+
+def read_meta(con):
+    return dict(con.execute("SELECT name, value FROM metadata").fetchall())
+
+
+def commune_fingerprints(data_dir, manifest, codes):
+    return {c: parcel_store.commune_fingerprint(data_dir, manifest, c) for c in codes}
+
+
+def build_archive(data_dir, minzoom=MIN_ZOOM, maxzoom=MAX_ZOOM, force=False):
+    """
+    Renders (or refreshes) the tile pyramid for every commune in the store.
+    Only communes whose fingerprint changed since the last build are re-tiled.
+    """
+    t0 = time.time()
+    manifest = parcel_store.read_manifest(data_dir)
+    if not parcel_store.is_fresh(manifest, data_dir):
+        parcel_store.build_store(data_dir)
+        manifest = parcel_store.read_manifest(data_dir)
+    codes = sorted(manifest["communes"])
+
+    path = archive_path(data_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    con = _connect(path)
+    meta = read_meta(con)
+    if meta.get("minzoom") != str(minzoom) or meta.get("maxzoom") != str(maxzoom):
+        force = True  # different pyramid, start over
+
+    current = commune_fingerprints(data_dir, manifest, codes)
+    previous = json.loads(meta.get("communes", "{}"))
+    changed = [c for c in codes if force or previous.get(c) != current[c]]
+    removed = [c for c in previous if c not in current]
+    if not changed and not removed:
+        print("Tile archive is up to date.", flush=True)
+        con.close()
+        return path
+    print(f"Re-tiling communes: {', '.join(changed + removed)}", flush=True)
+
+    if force:
+        con.execute("DELETE FROM tiles")
+        con.execute("DELETE FROM commune_tiles")
+
+    # Tiles to redo: wherever the changed communes were before and are now
+    todo = {}
+    for c in changed + removed:
+        for z, x, row in con.execute(
+                "SELECT zoom_level, tile_column, tile_row FROM commune_tiles WHERE commune = ?", (c,)):
+            todo.setdefault(z, set()).add((x, _tms_row(z, row)))
+        con.execute("DELETE FROM commune_tiles WHERE commune = ?", (c,))
+
+    # Neighbouring communes share border tiles, so render from the full merged frame
+    gdf = pd.concat([parcel_store.read_commune(data_dir, manifest, c) for c in codes], ignore_index=True)
+    gdf = parcel_store.apply_enrichments(gdf, parcel_store.read_enrichments(data_dir))
+    keys = parcel_store.commune_of(gdf['id'])
+
+    for c in changed:
+        part = gdf[keys == c]
+        rows = []
+        for z in range(minzoom, maxzoom + 1):
+            cover = covering_tiles(part, z)
+            todo.setdefault(z, set()).update(cover)
+            rows += [(c, z, x, _tms_row(z, y)) for x, y in cover]
+        con.executemany("INSERT INTO commune_tiles VALUES (?, ?, ?, ?)", rows)
+
+    rendered = 0
+    for z in sorted(todo):
+        level = parcel_store.lod_level(zoom=z)
+        geoms = parcel_store.lod_geometries(data_dir, manifest, gdf, level) if level else None
+        for x, y in sorted(todo[z]):
+            data = tiles.render_tile(gdf, z, x, y, geoms=geoms)
+            if data:
+                con.execute("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)", (z, x, _tms_row(z, y), data))
+            else:
+                con.execute("DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                            (z, x, _tms_row(z, y)))
+            rendered += 1
+        con.commit()
+        print(f"  z{z}: {len(todo[z])} tiles", flush=True)
+
+    w, s, e, n = gdf.total_bounds
+    meta = {
+        "name": "parcels",
+        "format": "pbf",
+        "type": "overlay",
+        "minzoom": str(minzoom),
+        "maxzoom": str(maxzoom),
+        "bounds": f"{w:.6f},{s:.6f},{e:.6f},{n:.6f}",
+        "json": json.dumps({"vector_layers": [{"id": tiles.LAYER_NAME, "fields": {}}]}),
+        "communes": json.dumps(current),
+    }
+    con.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?)", list(meta.items()))
+    con.commit()
+    con.execute("VACUUM")
+    con.close()
+    print(f"Tile archive built: {rendered} tiles rendered in {time.time() - t0:.0f}s -> {path}", flush=True)
+    return path
+
+
+class TileArchive:
+    """
+    Read-only access to the pre-rendered pyramid for the server.
+    Communes whose data changed after the build (upload, agent enrichment) are
+    marked stale and their tiles fall back to dynamic rendering.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.minzoom = self.maxzoom = None
+        self.fresh = set()
+        self._local = threading.local()
+
+    def open(self, data_dir, manifest):
+        self.minzoom = self.maxzoom = None
+        self.fresh = set()
+        if not os.path.exists(self.path) or manifest is None:
+            return False
+        # Throwaway connection: this may run in the gunicorn master before forking
+        con = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        try:
+            meta = read_meta(con)
+        finally:
+            con.close()
+        if "communes" not in meta:
+            return False  # build never finished
+        self.minzoom, self.maxzoom = int(meta["minzoom"]), int(meta["maxzoom"])
+        built = json.loads(meta.get("communes", "{}"))
+        current = commune_fingerprints(data_dir, manifest, sorted(manifest["communes"]))
+        self.fresh = {c for c, fp in current.items() if built.get(c) == fp}
+        stale = sorted(set(current) - self.fresh)
+        print(f"Tile archive z{self.minzoom}-{self.maxzoom} opened"
+              + (f" (stale communes, rendered live: {', '.join(stale)})" if stale else ""), flush=True)
+        return True
+
+    def _con(self):
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+            self._local.con = con
+        return con
+
+    def mark_stale(self, communes):
+        self.fresh -= set(communes)
+
+    def covers(self, z, communes):
+        """True if the archive can answer this tile on its own."""
+        if self.minzoom is None or not (self.minzoom <= z <= self.maxzoom):
+            return False
+        return all(c in self.fresh for c in communes)
+
+    def get(self, z, x, y):
+        row = self._con().execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (z, x, _tms_row(z, y))).fetchone()
+        return row[0] if row else b""
@@ -0,0 +1,266 @@
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import shapely
+
+# Mapbox Vector Tiles for the parcel layer.
+# Geometries are projected straight into tile pixel space, clipped to the tile
+# (plus a small buffer so strokes don't show seams), simplified to about one
+# pixel and snapped to the integer grid before encoding.
+TILE_EXTENT = 4096
+TILE_BUFFER = 64          # in tile units
+SIMPLIFY_TOLERANCE = 1.0  # in tile units (~1/16 of a screen pixel at 256px tiles)
+MIN_FEATURE_AREA = 16.0   # in tile units², smaller parcels would not cover a screen pixel
+LAYER_NAME = "parcels"
+MAX_ZOOM = 22
+
+# Properties the map styles and popups actually read
+TILE_PROPERTIES = [
+    'id', 'contenance', 'total_area_sqm', 'slope_mean', 'buildable_area_sqm',
+    'address', 'dist_to_hub', 'est_price_m2'
+]
+MIMETYPE = "application/vnd.mapbox-vector-tile"
+
+
+# --- Tile math (XYZ / Web Mercator) ---
+
+def valid_tile(z, x, y):
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def tile_bbox(z, x, y, buffer=0):
+    """(west, south, east, north) in degrees, optionally grown by buffer tile units."""
+    pad = buffer / TILE_EXTENT
+    n = 2 ** z
+
+    def lon(tx):
+        return tx / n * 360.0 - 180.0
+
+    def lat(ty):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * ty / n))))
+
+    return (lon(x - pad), lat(y + 1 + pad), lon(x + 1 + pad), lat(y - pad))
+
+
+def to_tile_coords(geoms, z, x, y):
+    """Projects lon/lat geometries into the tile's pixel space (y pointing down)."""
+    n = 2 ** z
+
+    def project(coords):
+        lon = coords[:, 0]
+        lat = np.radians(np.clip(coords[:, 1], -85.0511, 85.0511))
+        px = ((lon + 180.0) / 360.0 * n - x) * TILE_EXTENT
+        py = ((1.0 - np.log(np.tan(lat) + 1.0 / np.cos(lat)) / math.pi) / 2.0 * n - y) * TILE_EXTENT
+        return np.column_stack([px, py])
+
+    return shapely.transform(geoms, project)
+
+
+# --- Protobuf / MVT encoding ---
+# Written by hand (the spec only needs varints and length-delimited fields) to
+# avoid a protobuf dependency that conflicts with google-generativeai's.
+
+def _varint(n):
+    out = bytearray()
+    while True:
+        b = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return bytes(out)
+
+
+def _zigzag(n):
+    return (n << 1) ^ (n >> 63)
+
+
+def _field(num, wire, payload):
+    key = _varint((num << 3) | wire)
+    if wire == 2:
+        return key + _varint(len(payload)) + payload
+    return key + payload
+
+
+def _packed(values):
+    return b"".join(_varint(v) for v in values)
+
+
+def _encode_value(v):
+    if isinstance(v, str):
+        return _field(1, 2, v.encode("utf-8"))
+    if isinstance(v, (bool, np.bool_)):
+        return _field(7, 0, _varint(int(v)))
+    if isinstance(v, (int, np.integer)):
+        return _field(6, 0, _varint(_zigzag(int(v))))
+    # double
+    return _field(3, 1, np.float64(v).tobytes())
+
+
+def _ring_commands(coords, cursor):
+    """MoveTo + LineTo + ClosePath for one ring; coords already on the integer grid."""
+    pts = [(int(px), int(py)) for px, py in coords[:-1]]
+    if len(pts) < 3:
+        return None
+    cmds = []
+    cx, cy = cursor
+    x0, y0 = pts[0]
+    cmds += [(1 << 3) | 1, _zigzag(x0 - cx), _zigzag(y0 - cy)]
+    cmds.append(((len(pts) - 1) << 3) | 2)
+    px, py = x0, y0
+    for qx, qy in pts[1:]:
+        cmds += [_zigzag(qx - px), _zigzag(qy - py)]
+        px, py = qx, qy
+    cmds.append((1 << 3) | 7)
+    cursor[0], cursor[1] = px, py
+    return cmds
+
+
+def _signed_area(coords):
+    x = coords[:, 0]
+    y = coords[:, 1]
+    return 0.5 * np.sum(x[:-1] * y[1:] - x[1:] * y[:-1])
+
+
+def _polygon_commands(geom):
+    # MVT wants exterior rings clockwise on screen (positive shoelace area with y down)
+    # and interior rings the other way round
+    cmds = []
+    cursor = [0, 0]
+    polys = geom.geoms if geom.geom_type == "MultiPolygon" else [geom]
+    for poly in polys:
+        rings = [(np.asarray(poly.exterior.coords), 1)] + [(np.asarray(r.coords), -1) for r in poly.interiors]
+        for i, (coords, sign) in enumerate(rings):
+            area = _signed_area(coords)
+            if area == 0:
+                if i == 0:
+                    break  # degenerate shell: drop the whole polygon
+                continue
+            if (area > 0) != (sign > 0):
+                coords = coords[::-1]
+            ring = _ring_commands(coords, cursor)
+            if ring:
+                cmds += ring
+    return cmds
+
+
+def encode_layer(features, name=LAYER_NAME):
+    """features: iterable of (polygon geometry in tile coords, properties dict)."""
+    keys, key_index = [], {}
+    values, value_index = [], {}
+    encoded = []
+    for geom, props in features:
+        cmds = _polygon_commands(geom)
+        if not cmds:
+            continue
+        tags = []
+        for k, v in props.items():
+            if k not in key_index:
+                key_index[k] = len(keys)
+                keys.append(k)
+            vk = (type(v).__name__, v)
+            if vk not in value_index:
+                value_index[vk] = len(values)
+                values.append(v)
+            tags += [key_index[k], value_index[vk]]
+        feat = _field(2, 2, _packed(tags)) + _field(3, 0, _varint(3)) + _field(4, 2, _packed(cmds))
+        encoded.append(_field(2, 2, feat))
+
+    if not encoded:
+        return b""
+    layer = _field(15, 0, _varint(2)) + _field(1, 2, name.encode("utf-8"))
+    layer += b"".join(encoded)
+    layer += b"".join(_field(3, 2, k.encode("utf-8")) for k in keys)
+    layer += b"".join(_field(4, 2, _encode_value(v)) for v in values)
+    layer += _field(5, 0, _varint(TILE_EXTENT))
+    return _field(3, 2, layer)
+
+
+# --- Rendering ---
+
+def _clean(v):
+    if v is None:
+        return None
+    if isinstance(v, float) and math.isnan(v):
+        return None
+    if isinstance(v, np.floating):
+        return None if np.isnan(v) else float(v)
+    if isinstance(v, np.integer):
+        return int(v)
+    if isinstance(v, np.bool_):
+        return bool(v)
+    return v
+
+
+def render_tile(gdf, z, x, y, columns=TILE_PROPERTIES, tolerance=SIMPLIFY_TOLERANCE, geoms=None):
+    """
+    Encodes the parcels of gdf that touch tile z/x/y. Returns b"" for an empty tile.
+    geoms, if given, replaces gdf's geometry row for row (pre-simplified LOD).
+    """
+    if gdf is None or len(gdf) == 0:
+        return b""
+    hits = gdf.sindex.query(shapely.box(*tile_bbox(z, x, y, TILE_BUFFER)), predicate="intersects")
+    if len(hits) == 0:
+        return b""
+
+    source = gdf.geometry.values if geoms is None else geoms
+    geoms = to_tile_coords(np.asarray(source[hits]), z, x, y)
+    geoms = shapely.clip_by_rect(geoms, -TILE_BUFFER, -TILE_BUFFER,
+                                 TILE_EXTENT + TILE_BUFFER, TILE_EXTENT + TILE_BUFFER)
+
+    # At low zoom most parcels are sub-pixel: skip them rather than simplify and encode specks
+    keep = shapely.area(geoms) >= MIN_FEATURE_AREA
+    geoms, hits = geoms[keep], hits[keep]
+
+    geoms = shapely.simplify(geoms, tolerance, preserve_topology=True)
+    geoms = shapely.set_precision(geoms, 1.0)
+    keep = shapely.area(geoms) >= MIN_FEATURE_AREA
+    geoms, hits = geoms[keep], hits[keep]
+
+    cols = [c for c in columns if c in gdf.columns]
+    attrs = gdf[cols].iloc[hits].to_dict("records")
+
+    features = []
+    for geom, props in zip(geoms, attrs):
+        if geom is not None and geom.geom_type == "GeometryCollection":
+            # Snapping can leave slivers collapsed to lines next to the polygon
+            polys = [g for g in geom.geoms if g.geom_type in ("Polygon", "MultiPolygon")]
+            geom = shapely.union_all(polys) if polys else None
+        if geom is None or geom.is_empty or geom.geom_type not in ("Polygon", "MultiPolygon"):
+            continue
+        props = {k: _clean(v) for k, v in props.items()}
+        features.append((geom, {k: v for k, v in props.items() if v is not None}))
+    return encode_layer(features)
+
+
+class TileCache:
+    """Small thread-safe LRU of encoded tiles, keyed on (z, x, y)."""
+
+    def __init__(self, max_tiles=4096):
+        self.max_tiles = max_tiles
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._tiles.get(key)
+            if data is not None:
+                self._tiles.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        with self._lock:
+            self._tiles[key] = data
+            self._tiles.move_to_end(key)
+            while len(self._tiles) > self.max_tiles:
+                self._tiles.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+
+    def __len__(self):
+        return len(self._tiles)
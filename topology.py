@@ -0,0 +1,139 @@
+import json
+
+import numpy as np
+import pandas as pd
+import shapely
+
+# TopoJSON encoding of the parcel layer.
+# Cadastral parcels tile the plane, so in GeoJSON nearly every boundary is
+# written twice (once per neighbour). Here rings are cut at junctions into arcs,
+# each arc is stored once and referenced by index from both parcels (~index when
+# walked backwards), and arc coordinates are delta-encoded integers on the
+# quantization grid.
+OBJECT_NAME = "parcels"
+
+
+def _quantize(geoms, x0, y0, precision):
+    geom_type, coords, offsets = shapely.to_ragged_array(geoms)
+    if geom_type == shapely.GeometryType.POLYGON:
+        ring_off, poly_off = offsets
+        geom_off = np.arange(len(poly_off))
+    elif geom_type == shapely.GeometryType.MULTIPOLYGON:
+        ring_off, poly_off, geom_off = offsets
+    else:
+        raise ValueError(f"TopoJSON export only handles polygons, got {geom_type.name}")
+    q = np.rint((coords - [x0, y0]) / precision).astype(np.int64)
+    return q, ring_off, poly_off, geom_off
+
+
+def _junctions(q, ring_off):
+    """
+    Open ring vertices (closing point dropped) as int64 keys, plus a flag for the
+    vertices where rings branch: a point met with different neighbours in
+    different places starts/ends a shared arc.
+    """
+    lengths = np.diff(ring_off) - 1
+    keep = np.ones(len(q), dtype=bool)
+    keep[ring_off[1:] - 1] = False
+    v = q[keep]
+    keys = (v[:, 0] << 32) | v[:, 1]
+
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]) if len(lengths) else np.array([], dtype=np.int64)
+    first = np.repeat(starts, lengths)
+    size = np.repeat(lengths, lengths)
+    pos = np.arange(len(v)) - first
+    prev_k = keys[first + (pos - 1) % size]
+    next_k = keys[first + (pos + 1) % size]
+    pairs = pd.DataFrame({'p': keys, 'a': np.minimum(prev_k, next_k), 'b': np.maximum(prev_k, next_k)})
+    counts = pairs.drop_duplicates()['p'].value_counts()
+    is_junction = np.isin(keys, counts.index[counts.to_numpy() > 1])
+    return v, keys, is_junction, starts, lengths
+
+
+def _rotate_min(ring, keys):
+    i = int(np.argmin(keys))
+    ring = np.roll(ring, -i, axis=0)
+    return np.vstack([ring, ring[:1]])
+
+
+class _Arcs:
+    def __init__(self):
+        self.arcs = []
+        self.index = {}
+
+    def ref(self, arc, reverse_arc=None):
+        """Index of arc, ~index if it's already stored the other way round."""
+        k = arc.tobytes()
+        if k in self.index:
+            return self.index[k]
+        rev = (arc[::-1] if reverse_arc is None else reverse_arc).tobytes()
+        if rev in self.index:
+            return ~self.index[rev]
+        self.index[k] = len(self.arcs)
+        self.arcs.append(arc)
+        return len(self.arcs) - 1
+
+
+def _ring_arcs(arcs, v, keys, is_junction, start, length):
+    ring = v[start:start + length]
+    rkeys = keys[start:start + length]
+    js = np.flatnonzero(is_junction[start:start + length])
+    if len(js) == 0:
+        # Whole ring is one arc: compare it in a canonical rotation, both ways
+        rev = ring[::-1]
+        return [arcs.ref(_rotate_min(ring, rkeys), _rotate_min(rev, rkeys[::-1]))]
+    ring = np.roll(ring, -js[0], axis=0)
+    js = js - js[0]
+    bounds = list(js) + [length]
+    out = []
+    for a, b in zip(bounds[:-1], bounds[1:]):
+        arc = ring[a:b + 1] if b < length else np.vstack([ring[a:], ring[:1]])
+        out.append(arcs.ref(arc))
+    return out
+
+
+def _properties(gdf):
+    props = pd.DataFrame(gdf.drop(columns=gdf.geometry.name))
+    return json.loads(props.to_json(orient='records', date_format='iso'))
+
+
+def to_topojson(gdf, precision=1e-7):
+    """Encodes a polygon GeoDataFrame (lon/lat) as a TopoJSON string."""
+    if len(gdf) == 0:
+        return json.dumps({"type": "Topology", "objects": {OBJECT_NAME: {"type": "GeometryCollection",
+                                                                         "geometries": []}}, "arcs": []})
+    x0, y0, x1, y1 = [float(b) for b in gdf.total_bounds]
+    geoms = gdf.geometry.values
+    q, ring_off, poly_off, geom_off = _quantize(geoms, x0, y0, precision)
+    v, keys, is_junction, starts, lengths = _junctions(q, ring_off)
+
+    arcs = _Arcs()
+    rings = []
+    for r in range(len(lengths)):
+        rings.append(_ring_arcs(arcs, v, keys, is_junction, starts[r], lengths[r]) if lengths[r] >= 3 else None)
+
+    multi = shapely.get_type_id(geoms) == shapely.GeometryType.MULTIPOLYGON
+    geometries = []
+    for g, props in enumerate(_properties(gdf)):
+        polys = []
+        for p in range(geom_off[g], geom_off[g + 1]):
+            poly = [rings[r] for r in range(poly_off[p], poly_off[p + 1])]
+            if poly and poly[0] is not None:
+                polys.append([r for r in poly if r is not None])
+        if not polys:
+            geometries.append({"type": None, "properties": props})
+        elif multi[g]:
+            geometries.append({"type": "MultiPolygon", "arcs": polys, "properties": props})
+        else:
+            geometries.append({"type": "Polygon", "arcs": polys[0], "properties": props})
+
+    # Delta-encode: first point absolute, the rest relative to the previous one
+    encoded = [np.vstack([a[:1], np.diff(a, axis=0)]).tolist() for a in arcs.arcs]
+    topo = {
+        "type": "Topology",
+        "bbox": [x0, y0, x1, y1],
+        "transform": {"scale": [precision, precision], "translate": [x0, y0]},
+        "objects": {OBJECT_NAME: {"type": "GeometryCollection", "geometries": geometries}},
+        "arcs": encoded,
+    }
+    return json.dumps(topo, separators=(',', ':'))